@@ -1,11 +1,28 @@
+import hashlib
+import json
 import math
-from copy import deepcopy
+import sys
+import time
+from contextlib import nullcontext
 
 import numpy as np
-from PIL import Image, ImageChops, ImageDraw, ImageFilter
+from PIL import Image
+
+from FigureCache import FigureCache
+from MetricCache import MetricCache
+from MetricEngine import PAIR_METRICS, MetricEngine
+from PackedFigure import DEFAULT_THRESHOLD, PackedFigure, buildPyramids
+from PairTemplate import PairTemplate
+from PrunedScorer import PrunedScorer
+from Segmentation import segment
+from Trace import TraceWriter
+from VerbalScorer import VerbalScorer
+from TransformEngine import TransformSearch
 
 
 class Pair:
+    __slots__ = ('elem1', 'elem2', 'type', 'direction', 'testResults')
+
     def __init__(self, elem1, pair_type, direction, elem2=None):
         self.elem1 = elem1
         self.elem2 = elem2
@@ -20,36 +37,117 @@ class Pair:
         return "<% s % s Pair % s - % s >" % (self.direction, self.type,
                                               self.elem1.key, self.elem2.key if self.elem2 else 'NONE')
 
-    def run_tests(self, tests):
-        for test in tests:
-            name, result = test(self.elem1.img, self.elem2.img)
-            self.testResults[name] = result
-
+    def read_results(self, names, values):
+        self.testResults = dict(zip(names, values))
+
+
+# Structure-of-arrays record of one solved problem. The last axis of every
+# value array is the metric ID, i.e. the position in self.metrics:
+#
+# testerValues     (tester pairs, metrics)
+# candidateValues  (candidates, lonely testers, metrics)
+# diffs            (candidates, relations, metrics)
+# normalized       (candidates, relations, metrics)
+# scores           (candidates,)
+class ScoreTable:
+    __slots__ = ('metrics', 'template', 'elements', 'testerValues',
+                 'candidateValues', 'diffs', 'totalsForNorm', 'normalized',
+                 'scores')
+
+    def __init__(self, metrics, template, elements, testerValues,
+                 candidateValues):
+        self.metrics = metrics
+        self.template = template
+        self.elements = elements
+        self.testerValues = testerValues
+        self.candidateValues = candidateValues
+        self.diffs = None
+        self.totalsForNorm = None
+        self.normalized = None
+        self.scores = None
 
+    def calculate_diffs(self):
+        template = self.template
+        self.diffs = np.abs(self.testerValues[template.relationTester]
+                            - self.candidateValues[:, template.relationLonely])
+
+    # Every relation is normalized by its metric's total over all candidates
+    # and directions of the problem.
+    def normalize(self):
+        self.totalsForNorm = self.diffs.sum(axis=(0, 1))
+        self.normalized = np.divide(self.diffs, self.totalsForNorm,
+                                    out=np.zeros_like(self.diffs),
+                                    where=self.totalsForNorm != 0)
+        self.scores = self.normalized.sum(axis=(1, 2))
+
+    def testerPair(self, index):
+        template = self.template
+        pair_type, direction = template.groups[template.pairGroup[index]]
+        pair = Pair(self.elements[template.first[index]], pair_type,
+                    direction, self.elements[template.second[index]])
+        pair.read_results(self.metrics, self.testerValues[index].tolist())
+        return pair
+
+    def candidatePair(self, candidate, lonely):
+        template = self.template
+        pair_type, direction = template.groups[template.lonelyGroup[lonely]]
+        pair = Pair(self.elements[template.lonely[lonely]], pair_type,
+                    direction, candidate)
+        pair.read_results(
+            self.metrics,
+            self.candidateValues[candidate.position, lonely].tolist())
+        return pair
+
+
+# A view of one relation of a candidate in a ScoreTable. Pairs and diffs are
+# materialized from the table on access, for inspection only.
 class Relation:
-    def __init__(self, testerPair, candidatePair):
-        self.testerPair = testerPair
-        self.candidatePair = candidatePair
-        self.diffs = []
-        self.normalized_diffs = []
-        self.type = testerPair.type
-        self.direction = testerPair.direction
+    __slots__ = ('table', 'candidate', 'relation')
+
+    def __init__(self, table, candidate, relation):
+        self.table = table
+        self.candidate = candidate
+        self.relation = relation
 
     def __repr__(self):
         return "<Relation % s - % s >" % (self.testerPair, self.candidatePair)
 
-    def calculate_diffs(self):
-        for key in self.testerPair.testResults.keys():
-            tester_pair = self.testerPair.testResults[key]
-            candidate_pair = self.candidatePair.testResults[key]
-            diff = abs(tester_pair - candidate_pair)
-            self.diffs.append((key, diff))
+    @property
+    def testerPair(self):
+        return self.table.testerPair(
+            self.table.template.relationTester[self.relation])
+
+    @property
+    def candidatePair(self):
+        return self.table.candidatePair(
+            self.candidate, self.table.template.relationLonely[self.relation])
+
+    @property
+    def type(self):
+        return self.testerPair.type
+
+    @property
+    def direction(self):
+        return self.testerPair.direction
+
+    @property
+    def diffs(self):
+        values = self.table.diffs[self.candidate.position, self.relation]
+        return list(zip(self.table.metrics, values.tolist()))
+
+    @property
+    def normalized_diffs(self):
+        values = self.table.normalized[self.candidate.position, self.relation]
+        return list(zip(self.table.metrics, values.tolist()))
 
 
 class Element:
+    __slots__ = ('key', 'img', 'index')
+
     def __init__(self, key, img):
         self.key = key
         self.img = img
+        self.index = None
 
     def show(self):
         self.img.show()
@@ -59,32 +157,199 @@ class Element:
 
 
 class Candidate(Element):
+    __slots__ = ('score', 'table', 'position', 'pruned')
+
     def __init__(self, key, img):
         super().__init__(key, img)
         self.score = 0
-        self.pairs = []
-        self.relations = []
+        self.table = None
+        self.position = None
+        # Set when the candidate was ranked without a full score (see
+        # scoreCoarseToFine and scorePruned).
+        self.pruned = False
 
     def __repr__(self):
         return "<% s - KEY: % s>(% s)" % (type(self).__name__, self.key, self.score)
 
-    def add_pair(self, pair):
-        self.pairs.append(pair)
+    # Binds the candidate to its row of a solved problem's ScoreTable.
+    def attach(self, table, position):
+        self.table = table
+        self.position = position
+        self.score = table.scores[position].item()
+
+    @property
+    def pairs(self):
+        if self.table is None:
+            return []
+        return [self.table.candidatePair(self, lonely)
+                for lonely in range(self.table.template.lonely.size)]
 
-    def add_relation(self, relation):
-        self.relations.append(relation)
+    @property
+    def relations(self):
+        if self.table is None:
+            return []
+        return [Relation(self.table, self, relation)
+                for relation in range(self.table.template.relationLonely.size)]
 
 
 class Tester(Element):
-    def __init__(self, key, img):
-        super().__init__(key, img)
-        self.pairs = []
+    __slots__ = ()
 
 
 class Agent:
+    # PairTemplates by matrix degree, shared by every Agent.
+    pairTemplates = {}
+
+    # Pair metrics scored by default; any name registered in
+    # MetricEngine.PAIR_METRICS can be enabled instead.
+    defaultMetrics = [
+        'non_matching_pixel',
+        'darkness_ratio',
+        'pixel_intersect']
+
+    # The default metrics as a cascade: darkness_ratio only reads per-figure
+    # dark counts, the pixel comparisons follow on ambiguous problems.
+    defaultCascade = [
+        ['darkness_ratio'],
+        ['non_matching_pixel', 'pixel_intersect']]
+
+    # @param cacheDir Directory of the persistent binarized figure cache (see
+    #                FigureCache.py), or None to decode every PNG.
+    # @param coarseFactor Downsampling factor (2, 4 or 8) candidates are first
+    #                ranked at, or None to score at full resolution only.
+    # @param coarseMargin Relative gap between the coarse best and runner-up
+    #                score above which the coarse answer is kept; below it,
+    #                the problem is scored in full at full resolution.
+    # @param coarseTopK None for that full evaluation, or an approximate
+    #                refinement that re-scores only the k best coarse
+    #                candidates, normalized among themselves.
+    # @param metricCacheSize Pair metric values kept in memory across
+    #                problems, keyed by figure content (0 disables).
+    # @param metricCacheFile SQLite file backing the metric cache, shared by
+    #                every process that opens it (None for memory only).
+    # @param cascade Metric names per stage, cheapest first, replacing
+    #                metrics; a later stage only runs while the best
+    #                candidate's relative margin is below cascadeMargin.
+    #                True selects defaultCascade.
+    # @param pruning Approximate, answer-only branch-and-bound (see
+    #                PrunedScorer.py): stops scoring candidates that are
+    #                already worse than a fully scored one.
+    # @param verbose Print the best candidates and score table of every
+    #                problem.
+    # @param traceFile JSONL file every solved problem is recorded to (see
+    #                Trace.py); call close() to write out the last records.
+    # @param verbal  Score problems with verbal descriptions from their
+    #                object attributes, decoding the figures only when the
+    #                relative margin of the verbal answer is at most
+    #                verbalMargin (by default, when the best score is tied).
+    def __init__(self, threshold=DEFAULT_THRESHOLD,
+                 cacheDir=None, metrics=None,
+                 coarseFactor=None, coarseTopK=None, coarseMargin=0.3,
+                 metricCacheSize=0, metricCacheFile=None, cascade=None,
+                 cascadeMargin=0.5, verbose=False, traceFile=None,
+                 verbal=False, verbalMargin=0.0, pruning=False):
+        if coarseFactor not in (None, 2, 4, 8):
+            raise ValueError('Unknown coarse factor: %s' % coarseFactor)
+        if coarseTopK is not None and coarseTopK < 2:
+            raise ValueError('coarseTopK must keep at least 2 candidates')
+        if cascade is True:
+            cascade = self.defaultCascade
+        if coarseFactor and cascade:
+            raise ValueError('Coarse-to-fine and cascade scoring are '
+                             'exclusive')
+        if pruning and (coarseFactor or cascade):
+            raise ValueError('Pruning excludes coarse-to-fine and cascade '
+                             'scoring')
+        if cascade and metrics:
+            raise ValueError('A cascade defines its own metrics')
+        self.threshold = threshold
+        self.coarseFactor = coarseFactor
+        self.coarseTopK = coarseTopK
+        self.coarseMargin = coarseMargin
+        # Problems answered from the coarse ranking vs. re-scored at full
+        # resolution.
+        self.coarseStats = {'coarse': 0, 'refined': 0}
+        self.cascade = [list(names) for names in cascade or []]
+        self.cascadeMargin = cascadeMargin
+        # Problems decided at each cascade stage.
+        self.cascadeStats = [0] * len(self.cascade)
+        self.pruning = pruning
+        # Blocks evaluated vs. blocks a full evaluation would have needed,
+        # summed over the problems solved with pruning.
+        self.pruningStats = {'evaluated': 0, 'possible': 0}
+        self.verbal = verbal
+        self.verbalMargin = verbalMargin
+        self.verbalScorer = VerbalScorer() if verbal else None
+        # Verbal problems answered symbolically vs. handed to the image
+        # pipeline.
+        self.verbalStats = {'verbal': 0, 'fallback': 0}
+        if self.cascade:
+            metrics = [name for names in self.cascade for name in names]
+        self.figureCache = FigureCache(cacheDir) if cacheDir else None
+        self.metricCache = None
+        if metricCacheSize or metricCacheFile:
+            version = self.sourceDigest(
+                hashlib.sha1(), (MetricEngine, PackedFigure, TransformSearch,
+                                 segment))
+            self.metricCache = MetricCache(metricCacheSize, metricCacheFile,
+                                           version)
+        self.timer = None
+        self.verbose = verbose
+        self.trace = TraceWriter(traceFile) if traceFile else None
+        self.metrics = list(metrics or self.defaultMetrics)
+        unknown = [name for name in self.metrics if name not in PAIR_METRICS]
+        if unknown:
+            raise ValueError('Unknown metrics: %s' % ', '.join(unknown))
+
+    # Identifies everything that can change an answer: the scoring settings
+    # and the source of the modules doing the scoring.
+    def fingerprint(self):
+        config = {'threshold': self.threshold, 'metrics': self.metrics,
+                  'coarseFactor': self.coarseFactor,
+                  'coarseTopK': self.coarseTopK,
+                  'coarseMargin': self.coarseMargin,
+                  'cascade': self.cascade,
+                  'cascadeMargin': self.cascadeMargin,
+                  'verbal': self.verbal,
+                  'verbalMargin': self.verbalMargin,
+                  'pruning': self.pruning}
+        digest = hashlib.sha1(json.dumps(config, sort_keys=True).encode())
+        return self.sourceDigest(digest, (Agent, MetricEngine, PackedFigure,
+                                          PairTemplate, PrunedScorer,
+                                          TransformSearch, VerbalScorer,
+                                          segment))
+
+    @staticmethod
+    def sourceDigest(digest, classes):
+        for cls in classes:
+            with open(sys.modules[cls.__module__].__file__, 'rb') as r:
+                digest.update(r.read())
+        return digest.hexdigest()
+
+    # Writes out buffered trace records and releases the metric cache.
+    def close(self):
+        if self.trace is not None:
+            self.trace.close()
+        if self.metricCache is not None:
+            self.metricCache.close()
+
+    def stage(self, name):
+        if self.timer is None:
+            return nullcontext()
+        return self.timer.stage(name)
+
     def blackAndWhite(self, image):
-        image = image.convert('L')
-        return image.point(lambda x: 0 if x < 100 else 255, '1')
+        return PackedFigure.fromImage(image, self.threshold)
+
+    def loadFigure(self, figure):
+        packed = getattr(figure, 'packedFigure', None)
+        if packed is not None and packed.threshold == self.threshold:
+            return packed
+
+        fileName = figure.visualFilename
+        if self.figureCache is None:
+            return self.blackAndWhite(Image.open(fileName))
+        return self.figureCache.load(fileName, self.threshold)
 
     def initElements(self, problem):
         figures = sorted(problem.figures.items())
@@ -92,13 +357,14 @@ class Agent:
         candidates = []
 
         for key, obj in figures:
-            fileName = obj.visualFilename
-            img = self.blackAndWhite(Image.open(fileName))
+            img = self.loadFigure(obj)
             if key.isalpha():
                 testers.append(Tester(key, img))
             else:
                 candidates.append(Candidate(key, img))
 
+        if self.coarseFactor:
+            buildPyramids([element.img for element in testers + candidates])
         return np.array(testers), candidates
 
     def classicDiagonals(self, matrix):
@@ -176,6 +442,22 @@ class Agent:
 
         return lonelyTesters, diagonals
 
+    # Returns the PairTemplate for a problem with the given number of
+    # testers, building it from getTesterPairs the first time a degree is
+    # seen.
+    def getPairTemplate(self, testerCount):
+        degree = int(math.sqrt(testerCount + 1))
+        template = self.pairTemplates.get(degree)
+        if template is None:
+            slots = [Tester(str(index), None)
+                     for index in range(degree * degree - 1)]
+            for index, slot in enumerate(slots):
+                slot.index = index
+            lonelyTesters, testerPairs = self.getTesterPairs(np.array(slots))
+            template = PairTemplate(degree, lonelyTesters, testerPairs)
+            self.pairTemplates[degree] = template
+        return template
+
     def getTesterPairs(self, testers):
         probImgs = np.append(testers, None)
         degree = int(math.sqrt(probImgs.size))
@@ -252,45 +534,6 @@ class Agent:
 
         return lonelyTesters, testerPairs
 
-    def calcDarknessRatio(self, img1, img2):
-        arr = np.asarray(img1, dtype="int64")
-        arr2 = np.asarray(img2, dtype="int64")
-        count1 = np.count_nonzero(arr != 1)
-        count2 = np.count_nonzero(arr2 != 1)
-        if count2 == 0:
-            count2 = 1
-        return ('darkness_ratio', count1 / count2)
-
-    def calcDarkDiff(self, img1, img2):
-        arr = np.asarray(img1, dtype="int64")
-        arr2 = np.asarray(img2, dtype="int64")
-        size1 = arr.size
-        size2 = arr2.size
-        count1 = np.count_nonzero(arr != 1)
-        count2 = np.count_nonzero(arr2 != 1)
-        ratio1 = count1 / size1
-        ratio2 = count2 / size2
-        return ('dark_diff', ratio1 - ratio2)
-
-    def calcPixelIntersectRatio(self, img1, img2):
-        union = ImageChops.logical_and(img1, img2)
-        intersect = ImageChops.logical_or(img1, img2)
-        union_arr = np.asarray(union, dtype="int64")
-        intersect_arr = np.asarray(intersect, dtype="int64")
-        intersections = np.count_nonzero(intersect_arr != 1)
-        totalDark = np.count_nonzero(union_arr != 1)
-        if totalDark == 0:
-            totalDark = 1
-        return ('pixel_intersect', intersections / totalDark)
-
-    def calcNonMatchingPixelRatio(self, img1, img2):
-        xor = ImageChops.logical_xor(img1, img2)
-        inverted = ImageChops.invert(xor)
-        inverted_arr = np.asarray(inverted, dtype="int64")
-        nonmatching = np.count_nonzero(inverted_arr != 1)
-        totalPixels = inverted_arr.size
-        return ('non_matching_pixel', nonmatching / totalPixels)
-
     def getDiagonals(self, matrix):
         rows, cols = matrix.shape
         if rows < 3 & cols < 3:
@@ -306,63 +549,224 @@ class Agent:
             return diagonals
 
     def Solve(self, problem):
-        tests = [
-            self.calcNonMatchingPixelRatio,
-            self.calcDarknessRatio,
-            self.calcPixelIntersectRatio]
-
         # if "Basic Problem B-01" not in problem.name:
         #    return -1
-        print(problem.name)
-        testers, candidates = self.initElements(problem)
-        lonelyTesters, testerPairs = self.getTesterPairs(testers)
-
-        totalsForNorm = dict.fromkeys(testerPairs['adjacent'].keys(), {})
-
-        for candidate in candidates:
-            for pair in lonelyTesters:
-                pair_copy = deepcopy(pair)
-                pair_copy.set_elem2(candidate)
-                pair_copy.run_tests(tests)
-                candidate.add_pair(pair_copy)
-
-        for entry in list(testerPairs.values()):
-            for pairs in list(entry.values()):
-                for pair in pairs:
-                    pair.run_tests(tests)
-
-        for candidate in candidates:
-            for pair in candidate.pairs:
-
-                tester_pairs = testerPairs[pair.type][pair.direction]
-
-                for tester_pair in tester_pairs:
-                    relation = Relation(tester_pair, pair)
-                    relation.calculate_diffs()
-
-                    for test_name, diff in relation.diffs:
-                        if test_name not in totalsForNorm[pair.direction]:
-                            totalsForNorm[pair.direction][test_name] = 0
-
-                        totalsForNorm[pair.direction][test_name] += diff
-
-                    candidate.add_relation(relation)
-
-        for candidate in candidates:
-            for relation in candidate.relations:
-                for test_name, diff in relation.diffs:
-                    total = totalsForNorm[relation.direction][test_name]
-                    norm_score = 0 if total == 0 else diff / total
-                    candidate.score += norm_score
-                    normalized = (test_name, norm_score)
-                    relation.normalized_diffs.append(normalized)
-
-        candidates.sort(key=lambda candidate: candidate.score, reverse=False)
-
-        print("BEST: ", candidates[0].key, " SCORE: ", candidates[0].score)
-        print("RUNNER UP: ", candidates[1].key,
-              " SCORE: ", candidates[1].score)
-        print("Scores Table: ")
-        print(candidates, '\n')
+        start = time.perf_counter()
+        if self.verbose:
+            print(problem.name)
+        candidates = self.rank(problem)
+
+        if self.verbose:
+            print("BEST: ", candidates[0].key, " SCORE: ", candidates[0].score)
+            print("RUNNER UP: ", candidates[1].key,
+                  " SCORE: ", candidates[1].score)
+            print("Scores Table: ")
+            print(candidates, '\n')
+        if self.trace is not None:
+            self.trace.record(self.traceRecord(
+                problem, candidates, time.perf_counter() - start))
 
         return int(candidates[0].key)
+
+    # One trace line: timing, answer, margin, every candidate's score, and
+    # the normalized diffs of every relation of each candidate that has a
+    # ScoreTable row (candidates pruned by coarse-to-fine may not).
+    def traceRecord(self, problem, candidates, seconds):
+        record = {
+            'problem': problem.name,
+            'set': problem.problemSetName,
+            'seconds': seconds,
+            'answer': int(candidates[0].key),
+            'margin': self.margin(candidates),
+            'scores': [[candidate.key, candidate.score, candidate.pruned]
+                       for candidate in candidates],
+        }
+        tables = [candidate for candidate in candidates
+                  if candidate.table is not None]
+        if tables:
+            table = tables[0].table
+            template = table.template
+            keys = [element.key for element in table.elements]
+            record['metrics'] = list(table.metrics)
+            record['relations'] = [{
+                'type': template.groups[template.pairGroup[tester]][0],
+                'direction': template.groups[template.pairGroup[tester]][1],
+                'testers': [keys[template.first[tester]],
+                            keys[template.second[tester]]],
+                'lonely': keys[template.lonely[lonely]],
+            } for tester, lonely in zip(template.relationTester.tolist(),
+                                        template.relationLonely.tolist())]
+            record['normalized'] = {
+                candidate.key:
+                    candidate.table.normalized[candidate.position].tolist()
+                for candidate in tables}
+        return record
+
+    # Scores the problem's candidates and returns them best first.
+    def rank(self, problem):
+        if self.verbal and problem.hasVerbal:
+            with self.stage('verbal'):
+                candidates = self.rankVerbal(problem)
+            if candidates is not None:
+                return candidates
+
+        with self.stage('load'):
+            testers, candidates = self.initElements(problem)
+        with self.stage('pairs'):
+            template = self.getPairTemplate(testers.size)
+
+        elements = list(testers) + candidates
+        for index, element in enumerate(elements):
+            element.index = index
+
+        if self.coarseFactor:
+            self.scoreCoarseToFine(template, elements, candidates)
+        elif self.cascade:
+            self.scoreCascade(template, elements, candidates)
+        elif self.pruning:
+            with self.stage('pruning'):
+                self.scorePruned(template, elements, candidates)
+        else:
+            self.scoreAll(template, elements, candidates)
+
+        # Pruned candidates only have coarse or partial scores; they rank
+        # after every fully scored one.
+        candidates.sort(key=lambda candidate: (candidate.pruned,
+                                               candidate.score))
+        return candidates
+
+    # @param factor Pyramid level to score at; 1 is full resolution.
+    def scoreAll(self, template, elements, candidates, factor=1):
+        with self.stage('metrics'):
+            engine = MetricEngine([element.img.level(factor)
+                                   for element in elements],
+                                  self.metricCache)
+            testerValues, candidateValues = self.metricValues(
+                engine, template, self.metrics, len(candidates))
+        self.tabulate(self.metrics, template, elements, candidates,
+                      testerValues, candidateValues)
+
+    # Tester pairs are scored once; every candidate is paired with every
+    # lonely tester, giving a (candidates, lonely, metrics) block. Candidates
+    # are the last candidateCount figures of the engine.
+    def metricValues(self, engine, template, metrics, candidateCount):
+        figureCount = len(engine.figures)
+        candidateIndices = np.arange(figureCount - candidateCount,
+                                     figureCount)
+        testerValues = engine.metricMatrix(
+            metrics, template.first, template.second)
+        candidateValues = engine.metricMatrix(
+            metrics,
+            np.tile(template.lonely, candidateCount),
+            np.repeat(candidateIndices, template.lonely.size))
+        candidateValues = candidateValues.reshape(
+            candidateCount, template.lonely.size, len(metrics))
+        return testerValues, candidateValues
+
+    def tabulate(self, metrics, template, elements, candidates, testerValues,
+                 candidateValues):
+        table = ScoreTable(metrics, template, elements, testerValues,
+                           candidateValues)
+        with self.stage('relations'):
+            table.calculate_diffs()
+        with self.stage('normalization'):
+            table.normalize()
+            for position, candidate in enumerate(candidates):
+                candidate.attach(table, position)
+
+    # Ranks every candidate at the coarse level and keeps that ranking when
+    # the best candidate wins by a clear margin. Otherwise every candidate is
+    # scored again at full resolution, exactly as without coarse-to-fine.
+    # With coarseTopK, only the top-k are re-scored, normalized among
+    # themselves, and the rest are marked pruned so they rank after them in
+    # coarse order; that can change the answer.
+    def scoreCoarseToFine(self, template, elements, candidates):
+        with self.stage('coarse'):
+            self.scoreAll(template, elements, candidates, self.coarseFactor)
+
+        ranked = sorted(candidates, key=lambda candidate: candidate.score)
+        if self.margin(ranked) >= self.coarseMargin:
+            self.coarseStats['coarse'] += 1
+            return
+
+        self.coarseStats['refined'] += 1
+        if self.coarseTopK is None:
+            self.scoreAll(template, elements, candidates)
+            return
+        finalists = ranked[:self.coarseTopK]
+        for candidate in ranked[len(finalists):]:
+            candidate.pruned = True
+        subset = elements[:len(elements) - len(candidates)] + finalists
+        for index, element in enumerate(subset):
+            element.index = index
+        self.scoreAll(template, subset, finalists)
+
+    # Candidates scored this way have no ScoreTable; only the answer is
+    # exact up to PrunedScorer's approximation.
+    def scorePruned(self, template, elements, candidates):
+        engine = MetricEngine([element.img for element in elements],
+                              self.metricCache)
+        scorer = PrunedScorer(self.metrics, template, engine,
+                              np.array([candidate.index
+                                        for candidate in candidates]))
+        scores, pruned = scorer.run()
+        for candidate, score, flag in zip(candidates, scores.tolist(),
+                                          pruned.tolist()):
+            candidate.score = score
+            candidate.pruned = flag
+        self.pruningStats['evaluated'] += scorer.evaluated
+        self.pruningStats['possible'] += scorer.possibleBlocks()
+
+    # Ranks the candidates from their object attributes alone. Returns None
+    # when the answer is not clear enough, leaving the problem to the image
+    # pipeline. Candidates ranked this way have no image or ScoreTable.
+    def rankVerbal(self, problem):
+        figures = sorted(problem.figures.items())
+        testers = [figure for key, figure in figures if key.isalpha()]
+        keys = [key for key, figure in figures if not key.isalpha()]
+        template = self.getPairTemplate(len(testers))
+        scores = self.verbalScorer.scores(
+            testers + [problem.figures[key] for key in keys], template,
+            len(testers))
+
+        candidates = [Candidate(key, None) for key in keys]
+        for candidate, score in zip(candidates, scores):
+            candidate.score = score
+        candidates.sort(key=lambda candidate: candidate.score)
+        if self.margin(candidates) <= self.verbalMargin:
+            self.verbalStats['fallback'] += 1
+            return None
+        self.verbalStats['verbal'] += 1
+        return candidates
+
+    # Scores with the metrics of the first cascade stage and adds the next
+    # stage's metrics only while the best candidate's margin is below
+    # cascadeMargin. Values of earlier stages are reused, so the last stage's
+    # scores equal scoring with every metric at once.
+    def scoreCascade(self, template, elements, candidates):
+        with self.stage('metrics'):
+            engine = MetricEngine([element.img for element in elements],
+                                  self.metricCache)
+        metrics, testerValues, candidateValues = [], [], []
+        for stage, names in enumerate(self.cascade):
+            with self.stage('metrics'):
+                testers, values = self.metricValues(engine, template, names,
+                                                    len(candidates))
+            metrics += names
+            testerValues.append(testers)
+            candidateValues.append(values)
+            self.tabulate(metrics, template, elements, candidates,
+                          np.concatenate(testerValues, axis=-1),
+                          np.concatenate(candidateValues, axis=-1))
+
+            ranked = sorted(candidates, key=lambda candidate: candidate.score)
+            if (stage == len(self.cascade) - 1
+                    or self.margin(ranked) >= self.cascadeMargin):
+                self.cascadeStats[stage] += 1
+                return
+
+    # Relative gap between the best and the runner-up of ranked candidates.
+    @staticmethod
+    def margin(ranked):
+        best, runnerUp = ranked[0].score, ranked[1].score
+        return (runnerUp - best) / runnerUp if runnerUp > 0 else 0.0
@@ -0,0 +1,154 @@
+import argparse
+import json
+import os
+import struct
+
+import numpy as np
+from PIL import Image
+
+from PackedFigure import DEFAULT_THRESHOLD, PackedFigure
+
+MAGIC = b'RVPACK01'
+ALIGNMENT = 64
+
+# Layout of a pack file:
+#
+#   MAGIC | uint64 header length | JSON header | padding | pixel planes
+#
+# The header indexes every set, its problem list, each problem's
+# ProblemData.txt text and, per figure, [offset, height, width] of a packed
+# bit plane (rows of ceil(width / 8) bytes, 1 = dark) relative to the start
+# of the plane area. Planes start on ALIGNMENT-byte boundaries.
+
+
+def readLines(fileName):
+    with open(fileName) as r:
+        return [line.rstrip() for line in r if line.rstrip()]
+
+
+def figureNames(problemDir, problemName):
+    names = []
+    for fileName in sorted(os.listdir(problemDir)):
+        stem, ext = os.path.splitext(fileName)
+        if ext == '.png' and stem != problemName:
+            names.append(stem)
+    return names
+
+
+# Compiles the given sets (default: every set in ProblemSetList.txt) into one
+# pack file at outputName.
+def build(outputName, setNames=None, root='Problems',
+          threshold=DEFAULT_THRESHOLD):
+    if not setNames:
+        setNames = readLines(os.path.join(root, 'ProblemSetList.txt'))
+
+    header = {'threshold': threshold, 'sets': {}}
+    planes = []
+    offset = 0
+
+    for setName in setNames:
+        setDir = os.path.join(root, setName)
+        listName = os.path.join(setDir, 'ProblemList.txt')
+        if os.path.exists(listName):
+            problemNames = readLines(listName)
+        else:
+            problemNames = sorted(os.listdir(setDir))
+
+        entry = {'problems': problemNames, 'problemData': {}, 'figures': {}}
+        for problemName in problemNames:
+            problemDir = os.path.join(setDir, problemName)
+            dataName = os.path.join(problemDir, 'ProblemData.txt')
+            if os.path.exists(dataName):
+                with open(dataName) as r:
+                    entry['problemData'][problemName] = r.read()
+
+            figures = {}
+            for name in figureNames(problemDir, problemName):
+                image = Image.open(os.path.join(problemDir, name + '.png'))
+                figure = PackedFigure.fromImage(image, threshold)
+                figures[name] = [offset, figure.shape[0], figure.shape[1]]
+                plane = figure.bits.tobytes()
+                padding = -len(plane) % ALIGNMENT
+                planes.append(plane + b'\0' * padding)
+                offset += len(plane) + padding
+            entry['figures'][problemName] = figures
+        header['sets'][setName] = entry
+
+    encoded = json.dumps(header).encode('utf-8')
+    prefix = len(MAGIC) + 8 + len(encoded)
+    with open(outputName, 'wb') as w:
+        w.write(MAGIC)
+        w.write(struct.pack('<Q', len(encoded)))
+        w.write(encoded)
+        w.write(b'\0' * (-prefix % ALIGNMENT))
+        for plane in planes:
+            w.write(plane)
+
+
+# Read-only view of a pack file. The file is memory-mapped once and every
+# figure it serves is a PackedFigure whose bits are a zero-copy view into the
+# mapping.
+class CorpusPack:
+    def __init__(self, fileName):
+        self.fileName = fileName
+        with open(fileName, 'rb') as r:
+            if r.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not a corpus pack' % fileName)
+            length, = struct.unpack('<Q', r.read(8))
+            header = json.loads(r.read(length).decode('utf-8'))
+
+        prefix = len(MAGIC) + 8 + length
+        start = prefix + (-prefix % ALIGNMENT)
+        self.threshold = header['threshold']
+        self.sets = header['sets']
+        if os.path.getsize(fileName) > start:
+            self.data = np.memmap(fileName, dtype=np.uint8, mode='r',
+                                  offset=start)
+        else:
+            self.data = np.zeros(0, dtype=np.uint8)
+
+    def hasSet(self, setName):
+        return setName in self.sets
+
+    def problemNames(self, setName):
+        return self.sets[setName]['problems']
+
+    # Returns the ProblemData.txt text, or None if the pack was built from a
+    # folder without one.
+    def problemData(self, setName, problemName):
+        return self.sets[setName]['problemData'].get(problemName)
+
+    def figure(self, setName, problemName, figureName):
+        figures = self.sets[setName]['figures'].get(problemName, {})
+        if figureName not in figures:
+            return None
+        offset, height, width = figures[figureName]
+        rowBytes = (width + 7) // 8
+        bits = self.data[offset:offset + height * rowBytes]
+        return PackedFigure(bits.reshape(height, rowBytes), (height, width),
+                            self.threshold)
+
+    # Hands each RavensFigure of the problem its pre-binarized plane, which
+    # the Agent uses instead of decoding visualFilename.
+    def attachFigures(self, problem):
+        for name, figure in problem.figures.items():
+            packed = self.figure(problem.problemSetName, problem.name, name)
+            if packed is not None:
+                figure.packedFigure = packed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compile problem sets into one memory-mapped pack file.')
+    parser.add_argument('output', help='pack file to write')
+    parser.add_argument('sets', nargs='*',
+                        help='sets to include (default: ProblemSetList.txt)')
+    parser.add_argument('--root', default='Problems')
+    parser.add_argument('--threshold', type=int, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args()
+
+    build(args.output, args.sets, args.root, args.threshold)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+from PackedFigure import PackedFigure
+
+DEFAULT_CACHE_DIR = '.figure_cache'
+
+# Bytes before the packed rows of an entry: height and width as
+# little-endian uint32.
+HEADER_BYTES = 8
+
+
+# Persistent store of binarized figures, one raw .npy file per (PNG path,
+# threshold) named <path key>-<stat key>.npy. The stat key covers the PNG's
+# size and modification time, so a hit costs one stat() and one np.load of
+# a few KB, without reading the PNG; an edited PNG gets a new stat key, and
+# writing its entry removes the stale one, so the cache holds at most one
+# entry per figure. An entry is a flat uint8 array: the header, then the
+# packed rows, which the PackedFigure views in place. Entries are read
+# rather than memory-mapped: at this size a read is faster than a mapping,
+# and a mapping would hold a file descriptor per live figure.
+class FigureCache:
+    def __init__(self, directory=DEFAULT_CACHE_DIR):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        # Entry file names by path key, listed on the first miss so that
+        # writes find the stale entries to remove without a listing each.
+        self.entries = None
+
+    def pathKey(self, fileName, threshold):
+        key = '%s|%d' % (os.path.abspath(fileName), threshold)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def entryPath(self, fileName, threshold):
+        stat = os.stat(fileName)
+        return os.path.join(self.directory, '%s-%x-%x.npy' % (
+            self.pathKey(fileName, threshold), stat.st_size, stat.st_mtime_ns))
+
+    def listEntries(self):
+        self.entries = {}
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            names = []
+        for name in names:
+            if name.endswith('.npy'):
+                self.entries.setdefault(name.split('-')[0], set()).add(name)
+
+    def load(self, fileName, threshold):
+        entry = self.entryPath(fileName, threshold)
+        figure = self.read(entry, threshold)
+        if figure is not None:
+            self.hits += 1
+            return figure
+
+        self.misses += 1
+        figure = PackedFigure.fromImage(Image.open(fileName), threshold)
+        self.write(fileName, entry, figure)
+        return figure
+
+    def read(self, entry, threshold):
+        try:
+            data = np.load(entry)
+        except (OSError, ValueError):
+            return None
+        if data.dtype != np.uint8 or data.size < HEADER_BYTES:
+            return None
+        height, width = np.frombuffer(data[:HEADER_BYTES], dtype='<u4')
+        rowBytes = (int(width) + 7) // 8
+        if data.size != HEADER_BYTES + int(height) * rowBytes:
+            return None
+        return PackedFigure(data[HEADER_BYTES:].reshape(height, rowBytes),
+                            (height, width), threshold)
+
+    # Entries are written to a temporary file and renamed into place, so
+    # concurrent workers never observe a half-written entry. A cache that
+    # cannot be written (read-only checkout, full disk) is simply skipped.
+    def write(self, fileName, entry, figure):
+        header = np.array(figure.shape, dtype='<u4').view(np.uint8)
+        if self.entries is None:
+            self.listEntries()
+        names = self.entries.setdefault(
+            self.pathKey(fileName, figure.threshold), set())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as w:
+                np.save(w, np.concatenate([header, figure.bits.ravel()]))
+            os.replace(tmp, entry)
+            for name in names - {os.path.basename(entry)}:
+                os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+        names.clear()
+        names.add(os.path.basename(entry))
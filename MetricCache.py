@@ -0,0 +1,108 @@
+import sqlite3
+from collections import OrderedDict
+
+DEFAULT_MAX_ENTRIES = 1 << 16
+
+# Keys per SQLite query, keeping its 3 parameters per key under the default
+# limit of 999 host parameters.
+LOOKUP_BATCH = 300
+
+
+# Content-addressed store of pair metric values, keyed by the digests of the
+# two figures' pixels and the metric name. Figures that repeat across
+# problems (blank frames, shared shapes) then have their metrics computed
+# once. Symmetric metrics share one entry for (a, b) and (b, a).
+#
+# The in-memory tier is an LRU of at most maxEntries values. With a fileName,
+# misses fall through to an SQLite database that every worker process can
+# open; entries there are also keyed by version (a digest of the scoring
+# source), so values from older metric code are never served.
+class MetricCache:
+    def __init__(self, maxEntries=DEFAULT_MAX_ENTRIES, fileName=None,
+                 version=''):
+        self.maxEntries = maxEntries
+        self.fileName = fileName
+        self.version = version
+        self.entries = OrderedDict()
+        self.connection = None
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(first, second, metric):
+        if metric.symmetric and second < first:
+            first, second = second, first
+        return first, second, metric.name
+
+    def database(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.fileName, timeout=30)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS metrics (first TEXT, second TEXT,'
+                ' metric TEXT, version TEXT, value REAL,'
+                ' PRIMARY KEY (first, second, metric, version))')
+            self.connection.commit()
+        return self.connection
+
+    def remember(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+
+    # Returns the cached value of every key, None where there is none. Keys
+    # missing from memory are looked up in the database together.
+    def lookup(self, keys):
+        values = []
+        missing = {}
+        for index, key in enumerate(keys):
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            else:
+                missing.setdefault(key, []).append(index)
+            values.append(value)
+
+        if missing and self.fileName:
+            for key, value in self.lookupDatabase(list(missing)):
+                self.remember(key, value)
+                for index in missing.pop(key):
+                    values[index] = value
+                    self.diskHits += 1
+        self.misses += sum(len(indices) for indices in missing.values())
+        return values
+
+    def lookupDatabase(self, keys):
+        connection = self.database()
+        for start in range(0, len(keys), LOOKUP_BATCH):
+            batch = keys[start:start + LOOKUP_BATCH]
+            query = ('SELECT first, second, metric, value FROM metrics'
+                     ' WHERE version=? AND (first, second, metric) IN'
+                     ' (VALUES %s)' % ', '.join(['(?, ?, ?)'] * len(batch)))
+            for row in connection.execute(
+                    query, [self.version] + [part for key in batch
+                                             for part in key]):
+                yield row[:3], row[3]
+
+    def store(self, keys, values):
+        for key, value in zip(keys, values):
+            self.remember(key, value)
+        if self.fileName:
+            connection = self.database()
+            connection.executemany(
+                'INSERT OR IGNORE INTO metrics VALUES (?, ?, ?, ?, ?)',
+                [key + (self.version, value)
+                 for key, value in zip(keys, values)])
+            connection.commit()
+
+    def stats(self):
+        return {'hits': self.hits, 'diskHits': self.diskHits,
+                'misses': self.misses, 'entries': len(self.entries)}
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
@@ -0,0 +1,235 @@
+import numpy as np
+
+from PackedFigure import popcount, unionBox
+from Segmentation import descriptors, objectMatch, segment
+from TransformEngine import TransformSearch
+
+# Unary features are computed once per figure and memoized on it; pair
+# metrics read them (and the pixel counts of a PairBatch) to produce one
+# value per figure pair. Register new ones with the decorators below.
+UNARY_FEATURES = {}
+PAIR_METRICS = {}
+
+
+class PairMetric:
+    def __init__(self, name, compute, symmetric):
+        self.name = name
+        self.compute = compute
+        # Whether metric(a, b) == metric(b, a).
+        self.symmetric = symmetric
+
+    def __repr__(self):
+        return "<PairMetric % s>" % self.name
+
+
+def unaryFeature(name):
+    def register(compute):
+        UNARY_FEATURES[name] = compute
+        return compute
+    return register
+
+
+def pairMetric(name, symmetric=False):
+    def register(compute):
+        PAIR_METRICS[name] = PairMetric(name, compute, symmetric)
+        return compute
+    return register
+
+
+@unaryFeature('dark_count')
+def darkCount(figure):
+    return figure.darkCount
+
+
+@unaryFeature('dark_ratio')
+def darkRatio(figure):
+    return figure.darkCount / figure.size
+
+
+# Connected dark components of the figure (see Segmentation.segment).
+@unaryFeature('object_count')
+def objectCount(figure):
+    return len(figure.feature('objects', segment))
+
+
+def objectDescriptors(figure):
+    return figure.feature('object_descriptors', lambda figure: descriptors(
+        figure.feature('objects', segment), figure.shape))
+
+
+@pairMetric('non_matching_pixel', symmetric=True)
+def nonMatchingPixel(batch):
+    return batch.count('xor') / batch.size
+
+
+@pairMetric('darkness_ratio')
+def darknessRatio(batch):
+    return (batch.firstFeature('dark_count')
+            / np.maximum(batch.secondFeature('dark_count'), 1))
+
+
+@pairMetric('pixel_intersect', symmetric=True)
+def pixelIntersect(batch):
+    return batch.count('and') / np.maximum(batch.count('or'), 1)
+
+
+@pairMetric('dark_diff')
+def darkDiff(batch):
+    return batch.firstFeature('dark_ratio') - batch.secondFeature('dark_ratio')
+
+
+# Fraction of pixels still differing after the best alignment by a symmetry
+# of the square and a translation. Which symmetry that is (an index into
+# TransformEngine.TRANSFORMS) is categorical, so it is not a pair metric:
+# |index_a - index_b| would rank unrelated transforms by their list order.
+# PairBatch.alignment() exposes it as a feature.
+@pairMetric('transform_residual', symmetric=True)
+def transformResidual(batch):
+    return batch.alignment()[1]
+
+
+# Fraction of pixels still differing after the best translation alone.
+@pairMetric('shift_residual', symmetric=True)
+def shiftResidual(batch):
+    return batch.alignment()[2]
+
+
+@pairMetric('object_count_diff')
+def objectCountDiff(batch):
+    return (batch.firstFeature('object_count')
+            - batch.secondFeature('object_count'))
+
+
+# Cost of pairing up the two figures' objects by their feature vectors; it
+# only reads the per-figure object descriptors, never the pixels.
+@pairMetric('object_match', symmetric=True)
+def objectMatching(batch):
+    figures = batch.engine.figures
+    return np.array([objectMatch(objectDescriptors(figures[first]),
+                                 objectDescriptors(figures[second]))
+                     for first, second in zip(batch.first.tolist(),
+                                              batch.second.tolist())])
+
+
+BITWISE_OPS = {
+    'xor': np.bitwise_xor,
+    'and': np.bitwise_and,
+    'or': np.bitwise_or,
+}
+
+
+# The (first[i], second[i]) figure pairs of one metricMatrix call. Pixel
+# counts are computed on first request and shared by every metric of the
+# call, so a batch of unary-only metrics never touches the pixels.
+class PairBatch:
+    def __init__(self, engine, first, second):
+        self.engine = engine
+        self.first = first
+        self.second = second
+        self.size = engine.size
+        self.counts = {}
+        self.aligned = None
+
+    def count(self, op):
+        counts = self.counts.get(op)
+        if counts is None:
+            bits = self.engine.bits
+            combined = BITWISE_OPS[op](bits[self.first], bits[self.second])
+            counts = self.counts[op] = popcount(combined, axis=(1, 2))
+        return counts
+
+    # Returns the (transform, residual, shiftResidual) arrays of
+    # TransformSearch.search for the batch's pairs.
+    def alignment(self):
+        if self.aligned is None:
+            self.aligned = self.engine.transformSearch.search(self.first,
+                                                              self.second)
+        return self.aligned
+
+    def firstFeature(self, name):
+        return self.engine.unary(name)[self.first]
+
+    def secondFeature(self, name):
+        return self.engine.unary(name)[self.second]
+
+
+# Scores many figure pairs at once. All figures of a problem are stacked into
+# one (N, H, W/8) packed-bit tensor, and the xor/and/or pixel counts for a
+# batch of (first, second) index pairs come from a single broadcast op each.
+#
+# With a MetricCache, metricMatrix only evaluates the values the cache does
+# not hold, on a batch of the pairs missing any of them.
+class MetricEngine:
+    def __init__(self, figures, cache=None):
+        self.figures = figures
+        self.cache = cache
+        self.size = figures[0].size
+        self.stacked = None
+        self.unaryValues = {}
+        self.search = None
+
+    # Only the union of the figures' bounding boxes is stacked; the bits
+    # outside it are 0 in every figure and add nothing to any count.
+    @property
+    def bits(self):
+        if self.stacked is None:
+            top, bottom, left, right = unionBox(
+                [figure.bbox for figure in self.figures])
+            self.stacked = np.stack([figure.bits[top:bottom, left:right]
+                                     for figure in self.figures])
+        return self.stacked
+
+    @property
+    def transformSearch(self):
+        if self.search is None:
+            self.search = TransformSearch(self.figures)
+        return self.search
+
+    # Returns the named unary feature of every figure as an (N,) array.
+    def unary(self, name):
+        values = self.unaryValues.get(name)
+        if values is None:
+            compute = UNARY_FEATURES[name]
+            values = np.array([figure.feature(name, compute)
+                               for figure in self.figures])
+            self.unaryValues[name] = values
+        return values
+
+    def pairBatch(self, first, second):
+        return PairBatch(self, np.asarray(first, dtype=np.intp),
+                         np.asarray(second, dtype=np.intp))
+
+    # Returns a dense (pairs, metrics) matrix; column k holds metric names[k]
+    # for the pair (first[i], second[i]) in row i. Only the named metrics are
+    # evaluated.
+    def metricMatrix(self, names, first, second):
+        if self.cache is None:
+            return self.computeMatrix(names, first, second)
+
+        first = np.asarray(first, dtype=np.intp)
+        second = np.asarray(second, dtype=np.intp)
+        metrics = [PAIR_METRICS[name] for name in names]
+        digests = [figure.digest for figure in self.figures]
+        keys = [[self.cache.key(digests[a], digests[b], metric)
+                 for metric in metrics]
+                for a, b in zip(first.tolist(), second.tolist())]
+        values = np.array(self.cache.lookup([key for row in keys
+                                             for key in row]),
+                          dtype=np.float64).reshape(len(first), len(names))
+
+        missing = np.isnan(values)
+        if missing.any():
+            rows = missing.any(axis=1)
+            columns = np.flatnonzero(missing.any(axis=0))
+            computed = self.computeMatrix([names[k] for k in columns],
+                                          first[rows], second[rows])
+            values[np.ix_(rows, columns)] = computed
+            self.cache.store([keys[row][k] for row in np.flatnonzero(rows)
+                              for k in columns],
+                             computed.ravel().tolist())
+        return values
+
+    def computeMatrix(self, names, first, second):
+        batch = self.pairBatch(first, second)
+        columns = [PAIR_METRICS[name].compute(batch) for name in names]
+        return np.column_stack(columns).astype(np.float64)
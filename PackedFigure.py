@@ -0,0 +1,171 @@
+import hashlib
+
+import numpy as np
+from PIL import Image
+
+# Pixels darker than this (on the 0-255 greyscale) count as ink.
+DEFAULT_THRESHOLD = 100
+
+if hasattr(np, 'bitwise_count'):
+    def popcount(bits, axis=None):
+        return np.bitwise_count(bits).sum(axis=axis, dtype=np.int64)
+else:
+    _POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)],
+                               dtype=np.uint8)
+
+    def popcount(bits, axis=None):
+        return _POPCOUNT_TABLE[bits].sum(axis=axis, dtype=np.int64)
+
+
+# Downsampling factors of the resolution pyramid below full resolution.
+PYRAMID_FACTORS = (2, 4, 8)
+
+# Maps two packed bytes, read as one big-endian uint16, to the byte of their
+# bits OR-ed in pairs, so packed rows are halved without unpacking them.
+_PAIRS_OF_BYTE = (np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1)
+                  .reshape(256, 4, 2).any(axis=2)
+                  @ (1 << np.arange(3, -1, -1))).astype(np.uint8)
+HALVING_TABLE = ((_PAIRS_OF_BYTE[np.arange(65536) >> 8] << 4)
+                 | _PAIRS_OF_BYTE[np.arange(65536) & 255]).astype(np.uint8)
+
+
+def darkBox(bits):
+    rows = np.flatnonzero(bits.any(axis=1))
+    if rows.size == 0:
+        return 0, 0, 0, 0
+    columns = np.flatnonzero(np.bitwise_or.reduce(
+        bits[rows[0]:rows[-1] + 1], axis=0))
+    return (int(rows[0]), int(rows[-1]) + 1,
+            int(columns[0]), int(columns[-1]) + 1)
+
+
+# Smallest box holding all the given boxes; blank figures' boxes are ignored.
+def unionBox(boxes):
+    boxes = [box for box in boxes if box[1] > box[0]]
+    if not boxes:
+        return 0, 0, 0, 0
+    return (min(box[0] for box in boxes), max(box[1] for box in boxes),
+            min(box[2] for box in boxes), max(box[3] for box in boxes))
+
+
+# Halves figures of one shape together: only the union of their bounding
+# boxes is processed, in one array op per step, and each coarse bbox follows
+# from the figure's own bbox without a scan.
+def halveFigures(figures):
+    height, width = figures[0].shape
+    rowBytes = figures[0].bits.shape[1]
+    boxes = [(top // 2, -(-bottom // 2), left // 2, -(-right // 2))
+             for top, bottom, left, right in (figure.bbox
+                                              for figure in figures)]
+    bits = np.zeros((len(figures), -(-height // 2), -(-rowBytes // 2)),
+                    dtype=np.uint8)
+    top, bottom, left, right = unionBox(boxes)
+    if bottom > top:
+        block = np.zeros((len(figures), 2 * (bottom - top),
+                          2 * (right - left)), dtype=np.uint8)
+        for index, figure in enumerate(figures):
+            source = figure.bits[2 * top:2 * bottom, 2 * left:2 * right]
+            block[index, :source.shape[0], :source.shape[1]] = source
+        # OR pairs of rows, then look up each pair of bytes.
+        rows = block[:, 0::2] | block[:, 1::2]
+        bits[:, top:bottom, left:right] = HALVING_TABLE[rows.view('>u2')]
+
+    coarse = []
+    for index, (figure, box) in enumerate(zip(figures, boxes)):
+        level = PackedFigure(bits[index], (bits.shape[1], -(-width // 2)),
+                             figure.threshold)
+        level.features['bbox'] = box
+        coarse.append(level)
+    return coarse
+
+
+# Builds every PYRAMID_FACTORS level of the figures, halving the figures of
+# each shape together level by level.
+def buildPyramids(figures):
+    groups = {}
+    for figure in figures:
+        groups.setdefault((figure.shape, figure.bits.shape), []).append(figure)
+    for group in groups.values():
+        for factor in PYRAMID_FACTORS:
+            name = 'level_%d' % factor
+            missing = [figure for figure in group
+                       if name not in figure.features]
+            if not missing:
+                continue
+            levels = halveFigures([figure.level(factor // 2)
+                                   for figure in missing])
+            for figure, level in zip(missing, levels):
+                figure.features[name] = level
+
+
+# A binarized figure stored as rows of packed bits (1 = dark pixel), so every
+# pairwise comparison is a bitwise op plus a popcount over 1/8 of the pixels.
+class PackedFigure:
+    def __init__(self, bits, shape, threshold=None):
+        self.bits = bits
+        self.shape = tuple(int(n) for n in shape)
+        self.threshold = threshold
+        self.size = self.shape[0] * self.shape[1]
+        # Per-figure features, computed on first use (see feature()).
+        self.features = {}
+
+    @classmethod
+    def fromImage(cls, image, threshold=DEFAULT_THRESHOLD):
+        dark = np.asarray(image.convert('L')) < threshold
+        return cls.fromArray(dark, threshold)
+
+    @classmethod
+    def fromArray(cls, dark, threshold=None):
+        return cls(np.packbits(dark, axis=-1), dark.shape, threshold)
+
+    # Returns the named feature, computing it with compute(self) only the first
+    # time it is asked for.
+    def feature(self, name, compute):
+        value = self.features.get(name)
+        if value is None:
+            value = self.features[name] = compute(self)
+        return value
+
+    # (top, bottom, left, right) of the dark pixels, in rows and packed byte
+    # columns, half-open; (0, 0, 0, 0) for a blank figure. Every bit outside
+    # it is 0, so pixel counts over it equal those over the whole canvas.
+    @property
+    def bbox(self):
+        return self.feature('bbox', lambda figure: darkBox(figure.bits))
+
+    @property
+    def darkCount(self):
+        return self.feature('dark_count',
+                            lambda figure: int(popcount(figure.bits)))
+
+    # Returns the figure downsampled by a power-of-two factor, memoized, so
+    # each level of the pyramid is built once per figure (see also
+    # buildPyramids). Each level is halved from the one above it; a coarse
+    # pixel is dark if any pixel of its factor x factor block is.
+    def level(self, factor):
+        if factor == 1:
+            return self
+        return self.feature('level_%d' % factor, lambda figure: halveFigures(
+            [figure.level(factor // 2)])[0])
+
+    # SHA-1 of the shape and packed bits; figures with equal pixels share it
+    # whatever PNG they came from.
+    @property
+    def digest(self):
+        return self.feature('digest', lambda figure: hashlib.sha1(
+            repr(figure.shape).encode() + figure.bits.tobytes()).hexdigest())
+
+    def unpack(self):
+        return np.unpackbits(self.bits, axis=-1,
+                             count=self.shape[1]).astype(bool)
+
+    def toImage(self):
+        return Image.fromarray(~self.unpack())
+
+    def show(self):
+        self.toImage().show()
+
+    def __repr__(self):
+        return "<PackedFigure % sx% s DARK: % s>" % (self.shape[1],
+                                                    self.shape[0],
+                                                    self.darkCount)
@@ -0,0 +1,65 @@
+import numpy as np
+
+
+# Static pairing structure of an NxN matrix, flattened into index tables.
+# Built once per degree from the Pair objects Agent.getTesterPairs produces
+# for placeholder testers whose index is their position in the matrix, so
+# every later problem of that degree only needs a lookup.
+#
+# groups           (type, direction) label of each group of tester pairs
+# first, second    tester indices of each tester pair
+# pairGroup        group of each tester pair
+# lonely           tester index of each lonely tester (paired with a candidate)
+# lonelyGroup      group of each lonely tester
+# relationLonely,  one entry per relation a candidate takes part in: the
+# relationTester   lonely tester and the tester pair it is compared with
+# lonelyBlocks     per group with lonely testers (in order of appearance), the
+#                  positions of its lonely testers and of its relations
+class PairTemplate:
+    def __init__(self, degree, lonelyTesters, testerPairs):
+        self.degree = degree
+        self.groups = []
+        first, second, pairGroup = [], [], []
+        for pair_type, entry in testerPairs.items():
+            for direction, pairs in entry.items():
+                group = len(self.groups)
+                self.groups.append((pair_type, direction))
+                for pair in pairs:
+                    first.append(pair.elem1.index)
+                    second.append(pair.elem2.index)
+                    pairGroup.append(group)
+
+        lonely, lonelyGroup = [], []
+        for pair in lonelyTesters:
+            lonely.append(pair.elem1.index)
+            lonelyGroup.append(self.groups.index((pair.type, pair.direction)))
+
+        relationLonely, relationTester = [], []
+        for position, group in enumerate(lonelyGroup):
+            for index, other in enumerate(pairGroup):
+                if other == group:
+                    relationLonely.append(position)
+                    relationTester.append(index)
+
+        self.first = np.array(first, dtype=np.intp)
+        self.second = np.array(second, dtype=np.intp)
+        self.pairGroup = np.array(pairGroup, dtype=np.intp)
+        self.lonely = np.array(lonely, dtype=np.intp)
+        self.lonelyGroup = np.array(lonelyGroup, dtype=np.intp)
+        self.relationLonely = np.array(relationLonely, dtype=np.intp)
+        self.relationTester = np.array(relationTester, dtype=np.intp)
+
+        self.lonelyBlocks = []
+        for group in dict.fromkeys(lonelyGroup):
+            positions = [position for position, other in enumerate(lonelyGroup)
+                         if other == group]
+            relations = [relation for relation, position
+                         in enumerate(relationLonely)
+                         if lonelyGroup[position] == group]
+            self.lonelyBlocks.append((np.array(positions, dtype=np.intp),
+                                      np.array(relations, dtype=np.intp)))
+
+    def __repr__(self):
+        return "<PairTemplate % sx% s PAIRS: % s LONELY: % s RELATIONS: % s>" % (
+            self.degree, self.degree, self.first.size, self.lonely.size,
+            self.relationLonely.size)
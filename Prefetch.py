@@ -0,0 +1,80 @@
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Marks the end of the stream on the queue.
+DONE = object()
+
+
+# Decodes and binarizes the figures of upcoming problems on a thread pool
+# while the current problem is being scored. PIL releases the GIL while it
+# decodes, so the decoding mostly overlaps with Solve.
+#
+# A producer thread walks the job stream and queues each problem with the
+# futures of its figures; the queue holds at most `depth` problems, so at
+# most that many problems' figures are decoded ahead of the consumer.
+# Problems for which skip(set name, problem) is true, e.g. those a
+# SolveManifest already answers, are passed through without decoding.
+class Prefetcher:
+    def __init__(self, agent, depth=4, threads=None, skip=None):
+        self.agent = agent
+        self.depth = depth
+        self.threads = threads or min(4, os.cpu_count() or 1)
+        self.skip = skip
+
+    # Yields the (set name, problem) jobs in order, each problem's figures
+    # already loaded and attached as figure.packedFigure unless skipped.
+    def prefetch(self, jobs):
+        pending = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            producer = threading.Thread(
+                target=self.produce, args=(jobs, executor, pending, stop),
+                daemon=True)
+            producer.start()
+            try:
+                while True:
+                    item = pending.get()
+                    if item is DONE:
+                        break
+                    if isinstance(item, BaseException):
+                        raise item
+                    setName, problem, loads = item
+                    for figure, future in loads:
+                        figure.packedFigure = future.result()
+                    yield setName, problem
+            finally:
+                # Unblock a producer waiting on a full queue if the consumer
+                # stopped early, then let it exit.
+                stop.set()
+                while producer.is_alive():
+                    try:
+                        pending.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+                producer.join()
+
+    def produce(self, jobs, executor, pending, stop):
+        try:
+            for setName, problem in jobs:
+                if stop.is_set():
+                    return
+                if self.skip is not None and self.skip(setName, problem):
+                    loads = []
+                else:
+                    loads = [(figure, executor.submit(self.agent.loadFigure, figure))
+                             for _, figure in sorted(problem.figures.items())]
+                self.put(pending, (setName, problem, loads), stop)
+            self.put(pending, DONE, stop)
+        except BaseException as error:
+            self.put(pending, error, stop)
+
+    def put(self, pending, item, stop):
+        while not stop.is_set():
+            try:
+                pending.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
@@ -0,0 +1,297 @@
+import argparse
+import math
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageDraw
+
+SHAPES = ['circle', 'square', 'triangle', 'pentagon', 'star']
+# Shapes whose 90 degree rotations look different.
+ROTATABLE = ['triangle', 'pentagon', 'star']
+SIZES = ['small', 'medium', 'large', 'very large']
+SIZE_SCALES = {'small': 0.4, 'medium': 0.6, 'large': 0.8, 'very large': 1.0}
+MAX_OBJECTS = 3
+
+RULES = ['identity', 'fill', 'size', 'rotate', 'count', 'shape']
+
+# Figure names and answer count of each matrix size.
+LAYOUTS = {
+    '2x2': (['A', 'B', 'C'], 6),
+    '3x3': (['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H'], 8),
+}
+
+
+# Writes seeded synthetic problems in the layout ProblemSet reads:
+#
+#   <root>/ProblemSetList.txt
+#   <root>/<set>/ProblemList.txt
+#   <root>/<set>/<problem>/ProblemData.txt, ProblemAnswer.txt, A.png, ...
+#
+# Every row of a matrix starts from its own random objects and applies the
+# problem's rules once per column; the answer is the last cell. Distractors
+# are copies of the answer's left and upper neighbours plus single-attribute
+# mutations. ProblemData.txt carries the verbal description of every figure.
+# Each problem draws from its own Random seeded by (seed, problem number),
+# so the corpus is the same whatever the number of workers.
+
+
+def randomObjects(rng, rules, steps):
+    shapes = ROTATABLE if 'rotate' in rules else SHAPES
+    sizes = SIZES[:len(SIZES) - steps] if 'size' in rules else SIZES
+    count = rng.randint(1, MAX_OBJECTS - steps if 'count' in rules
+                        else MAX_OBJECTS)
+    objects = []
+    for _ in range(count):
+        shape = rng.choice(shapes)
+        objects.append({
+            'shape': shape,
+            'size': rng.choice(sizes),
+            'fill': rng.choice(['yes', 'no']),
+            'angle': str(rng.choice([0, 90, 180, 270])
+                         if shape in ROTATABLE else 0),
+        })
+    return objects
+
+
+# Applies a rule `steps` times. shapeCycle is the problem's order of shapes
+# for the 'shape' rule.
+def applyRule(objects, rule, steps, shapeCycle):
+    objects = [dict(obj) for obj in objects]
+    if rule == 'fill' and steps % 2:
+        for obj in objects:
+            obj['fill'] = 'no' if obj['fill'] == 'yes' else 'yes'
+    elif rule == 'size':
+        for obj in objects:
+            obj['size'] = SIZES[SIZES.index(obj['size']) + steps]
+    elif rule == 'rotate':
+        for obj in objects:
+            obj['angle'] = str((int(obj['angle']) + 90 * steps) % 360)
+    elif rule == 'count':
+        objects += [dict(objects[0]) for _ in range(steps)]
+    elif rule == 'shape':
+        for obj in objects:
+            index = shapeCycle.index(obj['shape'])
+            obj['shape'] = shapeCycle[(index + steps) % len(shapeCycle)]
+    return objects
+
+
+def signature(objects):
+    return tuple(tuple(sorted(obj.items())) for obj in objects)
+
+
+def mutate(rng, objects):
+    objects = [dict(obj) for obj in objects]
+    obj = rng.choice(objects)
+    change = rng.choice(['fill', 'size', 'shape', 'angle', 'count'])
+    if change == 'fill':
+        obj['fill'] = 'no' if obj['fill'] == 'yes' else 'yes'
+    elif change == 'size':
+        obj['size'] = rng.choice([size for size in SIZES
+                                  if size != obj['size']])
+    elif change == 'shape':
+        shapes = ROTATABLE if obj['angle'] != '0' else SHAPES
+        obj['shape'] = rng.choice([shape for shape in shapes
+                                   if shape != obj['shape']])
+    elif change == 'angle' and obj['shape'] in ROTATABLE:
+        obj['angle'] = str((int(obj['angle']) + 90 * rng.randint(1, 3)) % 360)
+    elif change == 'count':
+        if len(objects) > 1 and rng.random() < 0.5:
+            objects.remove(obj)
+        elif len(objects) < MAX_OBJECTS:
+            objects.append(dict(obj))
+    return objects
+
+
+# Returns ({figure name: objects}, answer).
+def makeProblem(rng, problemType, rules, composed):
+    testerNames, answerCount = LAYOUTS[problemType]
+    degree = 2 if problemType == '2x2' else 3
+    steps = degree - 1
+    chosen = rng.sample(rules, min(composed, len(rules)))
+    shapes = ROTATABLE if 'rotate' in chosen else SHAPES
+    shapeCycle = rng.sample(shapes, len(shapes))
+
+    cells = []
+    for _ in range(degree):
+        base = randomObjects(rng, chosen, steps)
+        for column in range(degree):
+            objects = base
+            for rule in chosen:
+                objects = applyRule(objects, rule, column, shapeCycle)
+            cells.append(objects)
+    answerObjects = cells[-1]
+
+    options = [answerObjects]
+    seen = {signature(answerObjects)}
+    for copied in (cells[-2], cells[-degree - 1]):
+        if len(options) < answerCount and signature(copied) not in seen:
+            seen.add(signature(copied))
+            options.append(copied)
+    while len(options) < answerCount:
+        candidate = mutate(rng, rng.choice(options))
+        if signature(candidate) not in seen:
+            seen.add(signature(candidate))
+            options.append(candidate)
+    order = list(range(answerCount))
+    rng.shuffle(order)
+
+    figures = dict(zip(testerNames, cells[:-1]))
+    for position, option in enumerate(order):
+        figures[str(position + 1)] = options[option]
+    return figures, order.index(0) + 1
+
+
+def polygon(cx, cy, radius, corners, angle, inner=None):
+    points = []
+    total = corners * (2 if inner else 1)
+    for i in range(total):
+        theta = math.radians(angle) - math.pi / 2 + 2 * math.pi * i / total
+        r = radius * inner if inner and i % 2 else radius
+        points.append((cx + r * math.cos(theta), cy + r * math.sin(theta)))
+    return points
+
+
+def render(objects, resolution):
+    image = Image.new('L', (resolution, resolution), 255)
+    draw = ImageDraw.Draw(image)
+    width = max(2, resolution // 92)
+    slot = resolution / len(objects)
+    for index, obj in enumerate(objects):
+        cx, cy = slot * (index + 0.5), resolution / 2
+        radius = 0.4 * min(slot, resolution) * SIZE_SCALES[obj['size']]
+        fill = 0 if obj['fill'] == 'yes' else None
+        angle = int(obj['angle'])
+        if obj['shape'] == 'circle':
+            draw.ellipse((cx - radius, cy - radius, cx + radius, cy + radius),
+                         fill=fill, outline=0, width=width)
+            continue
+        if obj['shape'] == 'square':
+            points = polygon(cx, cy, radius, 4, angle + 45)
+        elif obj['shape'] == 'triangle':
+            points = polygon(cx, cy, radius, 3, angle)
+        elif obj['shape'] == 'pentagon':
+            points = polygon(cx, cy, radius, 5, angle)
+        else:
+            points = polygon(cx, cy, radius, 5, angle, inner=0.45)
+        draw.polygon(points, fill=fill, outline=0, width=width)
+    return image
+
+
+def objectName(number):
+    name = ''
+    number += 1
+    while number:
+        number, remainder = divmod(number - 1, 26)
+        name = chr(ord('a') + remainder) + name
+    return name
+
+
+def writeProblem(directory, problemType, figures, answer, resolution):
+    os.makedirs(directory, exist_ok=True)
+    lines = [problemType, 'true', 'true']
+    number = 0
+    for name, objects in figures.items():
+        render(objects, resolution).save(os.path.join(directory,
+                                                      name + '.png'))
+        lines.append(name)
+        for obj in objects:
+            lines.append('\t' + objectName(number))
+            number += 1
+            lines.extend('\t\t%s:%s' % item for item in sorted(obj.items()))
+    with open(os.path.join(directory, 'ProblemData.txt'), 'w') as w:
+        w.write('\n'.join(lines) + '\n')
+    with open(os.path.join(directory, 'ProblemAnswer.txt'), 'w') as w:
+        w.write('%d' % answer)
+
+
+# One task per problem: (root, set name, problem name, number, options).
+def generateProblem(task):
+    root, setName, problemName, number, options = task
+    rng = random.Random('%d:%d' % (options['seed'], number))
+    problemType = options['size']
+    if problemType == 'mixed':
+        problemType = rng.choice(sorted(LAYOUTS))
+    figures, answer = makeProblem(rng, problemType, options['rules'],
+                                  options['composed'])
+    writeProblem(os.path.join(root, setName, problemName), problemType,
+                 figures, answer, options['resolution'])
+
+
+def generate(root, count, perSet=1000, prefix='Synthetic', seed=0,
+             size='mixed', resolution=184, rules=RULES, composed=1,
+             workers=1):
+    options = {'seed': seed, 'size': size, 'resolution': resolution,
+               'rules': list(rules), 'composed': composed}
+    digits = len(str(count))
+    tasks = []
+    problemLists = {}
+    for number in range(count):
+        setName = '%s Problems %d' % (prefix, number // perSet + 1)
+        problemName = '%s Problem %0*d' % (prefix, digits, number + 1)
+        problemLists.setdefault(setName, []).append(problemName)
+        tasks.append((root, setName, problemName, number, options))
+    setNames = list(problemLists)
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for _ in executor.map(generateProblem, tasks, chunksize=64):
+                pass
+    else:
+        for task in tasks:
+            generateProblem(task)
+
+    for setName, problemNames in problemLists.items():
+        with open(os.path.join(root, setName, 'ProblemList.txt'), 'w') as w:
+            w.write('\n'.join(problemNames) + '\n')
+
+    # Sets already listed keep their place; new ones are appended.
+    listName = os.path.join(root, 'ProblemSetList.txt')
+    listed = []
+    if os.path.exists(listName):
+        with open(listName) as r:
+            listed = [line.rstrip() for line in r if line.rstrip()]
+    with open(listName, 'w') as w:
+        w.write('\n'.join(listed + [name for name in setNames
+                                    if name not in listed]) + '\n')
+    return setNames
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Write seeded synthetic problem sets. Run the solver '
+                    'from the parent of --root, which it reads as Problems/.')
+    parser.add_argument('count', type=int, help='problems to generate')
+    parser.add_argument('--root', default='Problems')
+    parser.add_argument('--per-set', type=int, default=1000,
+                        help='problems per set')
+    parser.add_argument('--prefix', default='Synthetic',
+                        help='set and problem name prefix')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--size', choices=['2x2', '3x3', 'mixed'],
+                        default='mixed')
+    parser.add_argument('--resolution', type=int, default=184,
+                        help='figure width and height in pixels')
+    parser.add_argument('--rules', default=','.join(RULES),
+                        help='comma-separated rules to draw from: '
+                             + ', '.join(RULES))
+    parser.add_argument('--composed', type=int, default=1,
+                        help='rules combined in each problem')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes writing problems (0 uses every core)')
+    args = parser.parse_args()
+
+    rules = args.rules.split(',')
+    unknown = [rule for rule in rules if rule not in RULES]
+    if unknown:
+        parser.error('unknown rules: %s' % ', '.join(unknown))
+    workers = args.workers if args.workers > 0 else os.cpu_count()
+    setNames = generate(args.root, args.count, args.per_set, args.prefix,
+                        args.seed, args.size, args.resolution, rules,
+                        args.composed, workers)
+    print('Wrote %d problems in %d sets under %s' % (args.count,
+                                                     len(setNames), args.root))
+
+
+if __name__ == '__main__':
+    main()
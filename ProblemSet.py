@@ -8,7 +8,9 @@
 import random
 import re
 import os
+import io
 import json
+import fnmatch
 from RavensFigure import RavensFigure
 from RavensObject import RavensObject
 from RavensProblem import RavensProblem
@@ -23,30 +25,61 @@ class ProblemSet:
     # Your agent does not need to use this method.
     #
     # @param name The name of the problem set.
-    def __init__(self,name):
+    # @param pack An optional CorpusPack to read this set from instead of the
+    #             Problems folder.
+    # @param lazy If True, no problems are loaded up front; use iterProblems()
+    #             to parse them one at a time.
+    def __init__(self,name,pack=None,lazy=False):
         # The name of the problem set.
         self.name=name
 
         # A list of the problems in the problem set.
         self.problems=[]
 
-        self.loadProblemSet()
+        # The CorpusPack serving this set's problem data and pre-binarized
+        # figures, or None to read everything from disk.
+        self.pack=pack if pack is not None and pack.hasSet(name) else None
+
+        if not lazy:
+            self.loadProblemSet()
 
     # Loads the problem set from the folder whose name matches that of this
     # problem set.
     #
     # Your agent does not need to use this method.
     def loadProblemSet(self):
-        r = open("Problems" + os.sep + self.name + os.sep + "ProblemList.txt")
-        line = self.getNextLine(r)
-        while not line=="":
-            self.loadProblem(line)
-            line=self.getNextLine(r)
+        for problemName in self.problemNames():
+            self.loadProblem(problemName)
+
+    # Yields the names of the set's problems in ProblemList.txt order,
+    # reading the list one line at a time.
+    def problemNames(self):
+        if self.pack is not None:
+            yield from self.pack.problemNames(self.name)
+            return
+
+        with open("Problems" + os.sep + self.name + os.sep + "ProblemList.txt") as r:
+            line = self.getNextLine(r)
+            while not line=="":
+                yield line
+                line=self.getNextLine(r)
+
+    # Parses and yields the set's problems one at a time without keeping
+    # them, so each can be released once it is solved.
+    #
+    # @param pattern A glob on problem names; only matching problems are parsed.
+    def iterProblems(self, pattern="*"):
+        for problemName in self.problemNames():
+            if fnmatch.fnmatch(problemName, pattern):
+                yield self.parseProblem(problemName)
 
     def loadProblem(self, problemName):
+        self.problems.append(self.parseProblem(problemName))
+
+    def parseProblem(self, problemName):
         data_filename = "Problems" + os.sep + self.name + os.sep + problemName + os.sep + "ProblemData.txt"
 
-        with open(data_filename) as r:
+        with self.openProblemData(problemName, data_filename) as r:
             problemType=self.getNextLine(r)
 
             hasVisual=self.getNextLine(r)=="true"
@@ -94,7 +127,17 @@ class ProblemSet:
                     newProblem.figures["H"]=RavensFigure("H", problemName, self.name)
                     newProblem.figures["7"]=RavensFigure("7", problemName, self.name)
                     newProblem.figures["8"]=RavensFigure("8", problemName, self.name)
-            self.problems.append(newProblem)
+            if self.pack is not None:
+                self.pack.attachFigures(newProblem)
+            return newProblem
+
+    # Opens a problem's ProblemData.txt, preferring the copy held in the pack.
+    def openProblemData(self, problemName, data_filename):
+        if self.pack is not None:
+            text=self.pack.problemData(self.name, problemName)
+            if text is not None:
+                return io.StringIO(text)
+        return open(data_filename)
 
     # Returns the total number of problems answered in this set in a certain
     # type.
@@ -114,3 +157,21 @@ class ProblemSet:
 
     def getNextLine(self, r):
         return r.readline().rstrip()
+
+# Yields a lazy ProblemSet for every set in ProblemSetList.txt whose name
+# matches the glob, reading the list one line at a time.
+def iterProblemSets(pattern="*", pack=None):
+    with open(os.path.join("Problems","ProblemSetList.txt")) as r:
+        for line in r:
+            line=line.rstrip()
+            if line=="":
+                break
+            if fnmatch.fnmatch(line, pattern):
+                yield ProblemSet(line, pack, lazy=True)
+
+# Streams (set name, problem) for every matching problem of every matching
+# set, parsing one problem at a time.
+def iterProblems(setPattern="*", problemPattern="*", pack=None):
+    for problemSet in iterProblemSets(setPattern, pack):
+        for problem in problemSet.iterProblems(problemPattern):
+            yield problemSet.name, problem
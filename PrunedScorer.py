@@ -0,0 +1,82 @@
+import numpy as np
+
+
+# Answer-only pruning: finds the best candidate while skipping the relation
+# work of candidates that are clearly worse, instead of scoring every one.
+#
+# A candidate's score is sum_m D[m] / T[m], where D[m] is the sum of its
+# relation diffs for metric m and T[m] the same sum over all candidates. The
+# work is split into blocks, one per group of lonely testers, and each block
+# is evaluated for every live candidate in one MetricEngine call:
+#
+# 1. Every candidate gets the first block.
+# 2. The best candidate so far becomes the incumbent and is fully scored.
+# 3. Before each further block, a candidate is dropped once its partial D,
+#    divided by the running totals, exceeds the incumbent's score.
+#
+# The partial D only grows with more blocks, but the running totals are an
+# estimate of T, so a dropped candidate could in rare cases have won: this
+# is approximate. Only the answer is meaningful. Dropped candidates keep
+# their partial scores and are marked pruned, and the scores of the
+# remaining ones use totals that miss the dropped candidates' blocks.
+class PrunedScorer:
+    def __init__(self, metrics, template, engine, candidateIndices):
+        self.metrics = metrics
+        self.template = template
+        self.engine = engine
+        self.candidateIndices = candidateIndices
+        self.testerValues = engine.metricMatrix(metrics, template.first,
+                                                template.second)
+        self.raw = np.zeros((len(candidateIndices), len(metrics)))
+        self.evaluated = 0
+
+    def possibleBlocks(self):
+        return len(self.candidateIndices) * len(self.template.lonelyBlocks)
+
+    # Adds the diffs of the given blocks to the raw sums of the candidates,
+    # with one metric call for every (candidate, lonely tester) pair.
+    def evaluate(self, candidates, blocks):
+        template = self.template
+        positions = np.concatenate([template.lonelyBlocks[block][0]
+                                    for block in blocks])
+        relations = np.concatenate([template.lonelyBlocks[block][1]
+                                    for block in blocks])
+        values = np.zeros((len(candidates), template.lonely.size,
+                           len(self.metrics)))
+        values[:, positions] = self.engine.metricMatrix(
+            self.metrics, np.tile(template.lonely[positions], len(candidates)),
+            np.repeat(self.candidateIndices[candidates], positions.size)
+        ).reshape(len(candidates), positions.size, len(self.metrics))
+        diffs = np.abs(self.testerValues[template.relationTester[relations]]
+                       - values[:, template.relationLonely[relations]])
+        self.raw[candidates] += diffs.sum(axis=1)
+        self.evaluated += len(candidates) * len(blocks)
+
+    def scores(self):
+        totals = self.raw.sum(axis=0)
+        normalized = np.divide(self.raw, totals, out=np.zeros_like(self.raw),
+                               where=totals != 0)
+        return normalized.sum(axis=1)
+
+    # Returns (scores, pruned) arrays in candidate order.
+    def run(self):
+        count = len(self.candidateIndices)
+        blockCount = len(self.template.lonelyBlocks)
+        pruned = np.zeros(count, dtype=bool)
+        everyone = np.arange(count)
+        self.evaluate(everyone, [0])
+        if blockCount == 1:
+            return self.scores(), pruned
+
+        incumbent = int(np.argmin(self.scores()))
+        self.evaluate(np.array([incumbent]), range(1, blockCount))
+        live = everyone[everyone != incumbent]
+        for block in range(1, blockCount):
+            scores = self.scores()
+            beaten = scores[live] > scores[incumbent]
+            pruned[live[beaten]] = True
+            live = live[~beaten]
+            if live.size == 0:
+                break
+            self.evaluate(live, [block])
+        return self.scores(), pruned
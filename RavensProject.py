@@ -11,53 +11,217 @@
 import os
 import sys
 import csv
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 from Agent import Agent
-from ProblemSet import ProblemSet
+from FigureCache import DEFAULT_CACHE_DIR
+from MetricCache import DEFAULT_MAX_ENTRIES
+from CorpusPack import CorpusPack
+from Prefetch import Prefetcher
+from ProblemSet import iterProblems
 from RavensGrader import grade
+from SolveManifest import SolveManifest
 
-def getNextLine(r):
-    return r.readline().rstrip()
+# Each worker process of the parallel runner builds its own Agent once and
+# reuses it for every problem it is handed.
+workerAgent=None
+
+def initWorker(agentOptions):
+    global workerAgent
+    workerAgent=Agent(**agentOptions)
+
+def solveInWorker(problems):
+    answers=[workerAgent.Solve(problem) for problem in problems]
+    sys.stdout.flush()  # Pool workers exit without flushing their buffers.
+    if workerAgent.trace is not None:
+        workerAgent.trace.flush()
+    return answers
 
 # The project's main solve method. This will generate your agent's answers
 # to all the current problems.
 #
 # You do not need to use this method.
-def solve():
-    sets=[] # The variable 'sets' stores multiple problem sets.
-            # Each problem set comes from a different folder in /Problems/
-            # Additional sets of problems will be used when grading projects.
-            # You may also write your own problems.
-
-    r = open(os.path.join("Problems","ProblemSetList.txt"))    # ProblemSetList.txt lists the sets to solve.
-    line = getNextLine(r)                                   # Sets will be solved in the order they appear in the file.
-    while not line=="":                                     # You may modify ProblemSetList.txt for design and debugging.
-        sets.append(ProblemSet(line))                       # We will use a fresh copy of all problem sets when grading.
-        line=getNextLine(r)                                 # We will also use some problem sets not given in advance.
+#
+# @param workers Number of worker processes. With more than one, problems are
+#                spread across a process pool; answers are still written in
+#                set/problem order.
+# @param chunksize Problems handed to a worker at a time in parallel mode.
+# @param pack Optional CorpusPack file to load the sets from.
+# @param incremental Only re-solve problems whose inputs or Agent
+#                    configuration changed since the last incremental run;
+#                    the others reuse the answers in the solve manifest.
+# @param sets Glob on the set names in ProblemSetList.txt to solve.
+# @param problems Glob on the problem names to solve.
+# @param prefetch In sequential mode, decode the figures of up to this many
+#                 upcoming problems on background threads while the current
+#                 one is solved (0 disables).
+# @param metricCache Optional SQLite file caching pair metric values by figure
+#                    content, shared by every worker and later runs.
+# @param verbose Print every problem's best candidates and score table.
+# @param trace Optional JSONL file recording every solved problem (see Trace.py).
+# @param verbal Answer problems with verbal descriptions from their object
+#               attributes, decoding figures only when that is inconclusive.
+# @param figureCache Optional directory caching binarized figures across runs
+#                    (see FigureCache.py).
+def solve(workers=1, chunksize=1, pack=None, incremental=False, sets="*", problems="*", prefetch=0, metricCache=None, verbose=False, trace=None, verbal=False, figureCache=None):
+    corpus=CorpusPack(pack) if pack else None
+
+    # Problems are streamed: each one is parsed just before it is solved and
+    # released right after its answer is written, so memory does not grow
+    # with the size of the corpus. Sets are solved in the order they appear
+    # in ProblemSetList.txt.
+    jobs=iterProblems(sets, problems, corpus)
 
     # Initializing problem-solving agent from Agent.java
-    agent=Agent()   # Your agent will be initialized with its default constructor.
-                    # You may modify the default constructor in Agent.java
+    agentOptions=buildAgentOptions(metricCache, verbose, trace, verbal, figureCache)
+    agent=Agent(**agentOptions)   # Your agent will be initialized with its default constructor.
+                                  # You may modify the default constructor in Agent.java
+    manifest=SolveManifest(agent.fingerprint()) if incremental else None
+    if prefetch>0 and workers<=1:
+        # Problems the manifest will answer are not decoded ahead.
+        skip=None
+        if manifest is not None:
+            skip=lambda setName, problem: lookupAnswer(manifest, setName, problem)[1] is not None
+        jobs=Prefetcher(agent, prefetch, skip=skip).prefetch(jobs)
 
     # Running agent against each problem set
+    solved=total=0
     with open("AgentAnswers.csv","w") as results:     # Results will be written to ProblemResults.csv.
                                                         # Note that each run of the program will overwrite the previous results.
                                                         # Do not write anything else to ProblemResults.txt during execution of the program.
         results.write("ProblemSet,RavensProblem,Agent's Answer\n")
-        for set in sets:
-            for problem in set.problems:   # Your agent will solve one problem at a time.
-                #try:
-                answer = agent.Solve(problem)  # The problem will be passed to your agent as a RavensProblem object as a parameter to the Solve method
-                                                # Your agent should return its answer at the conclusion of the execution of Solve.
+        for setName, problem, answer, fresh in solveStream(jobs, agent, workers, chunksize, manifest, agentOptions=agentOptions):
+            results.write("%s,%s,%d\n" % (setName, problem.name, answer))
+            solved+=fresh
+            total+=1
+
+    agent.close()
+    if manifest is not None:
+        manifest.save()
+        print("Re-solved %d of %d problems" % (solved, total))
+
+# Agent keyword arguments for solve's options, shared with the worker
+# processes of the parallel runner and ShardRunner.py.
+def buildAgentOptions(metricCache=None, verbose=False, trace=None, verbal=False, figureCache=None):
+    agentOptions=dict(verbose=verbose, traceFile=trace, verbal=verbal, cacheDir=figureCache)
+    if metricCache:
+        agentOptions.update(metricCacheSize=DEFAULT_MAX_ENTRIES, metricCacheFile=metricCache)
+    return agentOptions
+
+# Yields (set name, problem, answer, fresh) for every job in the order the
+# jobs come in. With a manifest, problems whose fingerprint is unchanged reuse
+# the recorded answer (fresh is False) and only the others are solved.
+#
+# With more than one worker, problems to solve are grouped into chunks for a
+# process pool. At most 2 * workers chunks are in flight and at most
+# maxPending answers wait to be written, which bounds memory on long streams.
+# Worker processes build their Agent from agentOptions.
+def solveStream(jobs, agent, workers, chunksize, manifest=None, maxPending=1024, agentOptions=None):
+    if workers<=1:
+        for setName, problem in jobs:
+            fingerprint, answer=lookupAnswer(manifest, setName, problem)
+            fresh=answer is None
+            if fresh:
+                answer=agent.Solve(problem)   # Your agent will solve one problem at a time.
+                recordAnswer(manifest, setName, problem, fingerprint, answer)
+            yield setName, problem, answer, fresh
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=initWorker, initargs=(agentOptions or {},)) as executor:
+        pending=deque()     # [setName, problem, fingerprint, answer, future, position, last]
+        chunk=[]            # Pending entries to solve that are not submitted yet.
+        outstanding=0       # Submitted chunks whose answers are not all written.
 
-                results.write("%s,%s,%d\n" % (set.name, problem.name, answer))
-    r.close()
+        def submitChunk():
+            nonlocal outstanding
+            future=executor.submit(solveInWorker, [entry[1] for entry in chunk])
+            for position, entry in enumerate(chunk):
+                entry[4:7]=[future, position, position==len(chunk)-1]
+            outstanding+=1
+            chunk.clear()
+
+        def isReady(entry):
+            return entry[3] is not None or (entry[4] is not None and entry[4].done())
+
+        def popHead():
+            nonlocal outstanding
+            entry=pending[0]
+            setName, problem, fingerprint, answer=entry[:4]
+            fresh=answer is None
+            if fresh:
+                if entry[4] is None:
+                    submitChunk()
+                future, position, last=entry[4:7]
+                answer=future.result()[position]
+                recordAnswer(manifest, setName, problem, fingerprint, answer)
+                outstanding-=last
+            pending.popleft()
+            return setName, problem, answer, fresh
+
+        for setName, problem in jobs:
+            fingerprint, answer=lookupAnswer(manifest, setName, problem)
+            entry=[setName, problem, fingerprint, answer, None, None, False]
+            pending.append(entry)
+            if answer is None:
+                chunk.append(entry)
+                if len(chunk)>=chunksize:
+                    submitChunk()
+            while pending and (isReady(pending[0]) or len(pending)>maxPending or outstanding>=2*workers):
+                yield popHead()
+
+        if chunk:
+            submitChunk()
+        while pending:
+            yield popHead()
+
+def lookupAnswer(manifest, setName, problem):
+    if manifest is None:
+        return None, None
+    fingerprint=manifest.fingerprint(problem)
+    return fingerprint, manifest.answer(setName, problem.name, fingerprint)
+
+def recordAnswer(manifest, setName, problem, fingerprint, answer):
+    if manifest is not None:
+        manifest.record(setName, problem.name, fingerprint, answer)
 
 # The main execution will have your agent generate answers for all the problems,
 # then generate the grades for them.
 def main():
-    solve()
-    grade()
+    parser=argparse.ArgumentParser(description="Solve and grade the problem sets listed in Problems/ProblemSetList.txt.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes to solve with (0 uses every core)")
+    parser.add_argument("--chunksize", type=int, default=1,
+                        help="problems handed to a worker at a time")
+    parser.add_argument("--pack",
+                        help="corpus pack (see CorpusPack.py) to load the sets from")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only re-solve problems whose inputs changed since the last run")
+    parser.add_argument("--sets", default="*",
+                        help="glob on set names to solve (default: all)")
+    parser.add_argument("--problems", default="*",
+                        help="glob on problem names to solve (default: all)")
+    parser.add_argument("--prefetch", type=int, default=0,
+                        help="problems to decode ahead on background threads (sequential mode)")
+    parser.add_argument("--metric-cache",
+                        help="SQLite file caching pair metrics by figure content across workers and runs")
+    parser.add_argument("--verbose", action="store_true",
+                        help="print every problem's best candidates and score table")
+    parser.add_argument("--trace",
+                        help="append a JSONL record of every solved problem to this file")
+    parser.add_argument("--verbal", action="store_true",
+                        help="solve from verbal descriptions where they exist, falling back to the figures")
+    parser.add_argument("--figure-cache", nargs="?", const=DEFAULT_CACHE_DIR,
+                        help="cache binarized figures in this directory across runs (default: %s)" % DEFAULT_CACHE_DIR)
+    args=parser.parse_args()
+
+    workers=args.workers if args.workers>0 else os.cpu_count()
+    solve(workers, args.chunksize, args.pack, args.incremental, args.sets, args.problems, args.prefetch, args.metric_cache, args.verbose, args.trace, args.verbal, args.figure_cache)
+
+    # The grader expects an answer for every listed problem.
+    if args.sets=="*" and args.problems=="*":
+        grade()
 
 if __name__ == "__main__":
     main()
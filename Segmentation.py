@@ -0,0 +1,150 @@
+import numpy as np
+
+# Components smaller than this many pixels (binarization specks) are dropped.
+MIN_OBJECT_AREA = 4
+
+# Columns of the per-object feature array. Coordinates are in pixels, the
+# bounding box is half-open, the perimeter counts pixel edges between the
+# object and the background, and mu20/mu02/mu11 are the central second
+# moments divided by the area.
+OBJECT_FEATURES = ['area', 'cy', 'cx', 'top', 'left', 'bottom', 'right',
+                   'perimeter', 'mu20', 'mu02', 'mu11']
+COLUMN = {name: index for index, name in enumerate(OBJECT_FEATURES)}
+
+
+# Horizontal runs of dark pixels as (row, start, end) arrays, ordered by row
+# and then start; end is exclusive.
+def findRuns(dark):
+    height, width = dark.shape
+    padded = np.zeros((height, width + 2), dtype=np.int8)
+    padded[:, 1:-1] = dark
+    edges = np.diff(padded, axis=1)
+    startRows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    return startRows, starts, ends
+
+
+# Pairs (a, b) of runs in consecutive rows that touch, 8-connected. The runs
+# of a row are disjoint and sorted, so the runs of row r - 1 touching a run
+# of row r form one range, found with two searchsorted calls on keys that
+# put every row in its own interval.
+def touchingRuns(rows, starts, ends, width):
+    stride = width + 2
+    startKeys = rows * stride + starts
+    endKeys = rows * stride + ends
+    above = (rows - 1) * stride
+    low = np.searchsorted(endKeys, above + starts, side='left')
+    high = np.searchsorted(startKeys, above + ends, side='right')
+    counts = np.maximum(high - low, 0)
+    second = np.repeat(np.arange(rows.size), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                  counts)
+    first = np.repeat(low, counts) + offsets
+    return first, second
+
+
+# Union-find over the touching pairs by label propagation with pointer
+# jumping, all in array ops; returns component labels 0..K-1 per run.
+def labelRuns(count, first, second):
+    labels = np.arange(count)
+    while True:
+        lowest = np.minimum(labels[first], labels[second])
+        updated = labels.copy()
+        np.minimum.at(updated, first, lowest)
+        np.minimum.at(updated, second, lowest)
+        while True:
+            jumped = updated[updated]
+            if np.array_equal(jumped, updated):
+                break
+            updated = jumped
+        if np.array_equal(updated, labels):
+            break
+        labels = updated
+    return np.unique(labels, return_inverse=True)[1]
+
+
+def sumOfSquares(n):
+    return n * (n + 1) * (2 * n + 1) / 6
+
+
+# Labels the figure's 8-connected dark components from its runs and returns
+# their OBJECT_FEATURES as a (objects, features) array, largest first.
+def segment(figure):
+    dark = figure.unpack()
+    rows, starts, ends = findRuns(dark)
+    if rows.size == 0:
+        return np.zeros((0, len(OBJECT_FEATURES)))
+    first, second = touchingRuns(rows, starts, ends, dark.shape[1])
+    labels = labelRuns(rows.size, first, second)
+    count = labels.max() + 1
+
+    lengths = (ends - starts).astype(np.float64)
+    xSums = lengths * (starts + ends - 1) / 2
+    xSquares = sumOfSquares(ends - 1.0) - sumOfSquares(starts - 1.0)
+
+    def total(values):
+        return np.bincount(labels, weights=values, minlength=count)
+
+    area = total(lengths)
+    cy = total(lengths * rows) / area
+    cx = total(xSums) / area
+    mu20 = total(xSquares) / area - cx ** 2
+    mu02 = total(lengths * rows ** 2) / area - cy ** 2
+    mu11 = total(rows * xSums) / area - cx * cy
+
+    top = np.full(count, dark.shape[0])
+    left = np.full(count, dark.shape[1])
+    bottom = np.zeros(count, dtype=np.intp)
+    right = np.zeros(count, dtype=np.intp)
+    np.minimum.at(top, labels, rows)
+    np.minimum.at(left, labels, starts)
+    np.maximum.at(bottom, labels, rows + 1)
+    np.maximum.at(right, labels, ends)
+
+    # Every run has 2 side edges and its length on top and bottom; each
+    # pixel shared with a run of the row above hides one edge of each.
+    shared = np.maximum(np.minimum(ends[first], ends[second])
+                        - np.maximum(starts[first], starts[second]), 0)
+    perimeter = total(2 + 2 * lengths) - 2 * np.bincount(
+        labels[first], weights=shared, minlength=count)
+
+    objects = np.column_stack([area, cy, cx, top, left, bottom, right,
+                               perimeter, mu20, mu02, mu11])
+    objects = objects[area >= MIN_OBJECT_AREA]
+    return objects[np.argsort(-objects[:, 0], kind='stable')]
+
+
+# Position- and scale-aware descriptors compared by objectMatch: area and
+# centroid relative to the canvas, compactness, and elongation.
+def descriptors(objects, shape):
+    area = objects[:, COLUMN['area']]
+    mu20 = objects[:, COLUMN['mu20']]
+    mu02 = objects[:, COLUMN['mu02']]
+    mu11 = objects[:, COLUMN['mu11']]
+    spread = np.sqrt((mu20 - mu02) ** 2 + 4 * mu11 ** 2)
+    major = (mu20 + mu02 + spread) / 2
+    minor = (mu20 + mu02 - spread) / 2
+    return np.column_stack([
+        np.sqrt(area / (shape[0] * shape[1])),
+        objects[:, COLUMN['cy']] / shape[0],
+        objects[:, COLUMN['cx']] / shape[1],
+        4 * np.pi * area / np.maximum(objects[:, COLUMN['perimeter']], 1) ** 2,
+        np.sqrt(np.maximum(minor, 0) / np.maximum(major, 1e-9)),
+    ])
+
+
+# Cost of matching two figures' objects: objects are paired greedily by
+# smallest descriptor L1 distance, every unpaired object costs 1, and the
+# total is divided by the larger object count (0 for two blank figures).
+def objectMatch(first, second):
+    count = max(len(first), len(second))
+    if count == 0:
+        return 0.0
+    costs = np.abs(first[:, None, :] - second[None, :, :]).sum(axis=2)
+    total = float(count - min(len(first), len(second)))
+    for _ in range(min(len(first), len(second))):
+        row, column = np.unravel_index(np.argmin(costs), costs.shape)
+        total += min(costs[row, column], 1.0)
+        costs[row, :] = np.inf
+        costs[:, column] = np.inf
+    return total / count
@@ -0,0 +1,477 @@
+import argparse
+import csv
+import fnmatch
+import glob
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+from Agent import Agent
+from CorpusPack import CorpusPack
+from FigureCache import DEFAULT_CACHE_DIR
+from ProblemSet import ProblemSet, iterProblemSets
+from RavensGrader import grade
+from RavensProject import buildAgentOptions
+
+DEFAULT_BATCH_SIZE = 16
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_POLL_SECONDS = 1.0
+ANSWER_COLUMN = "Agent's Answer"
+RUN_FILE = 'run.json'
+
+# Splits RavensProject.solve across nodes that share a directory (e.g. over
+# NFS). Every node runs one or more worker processes against it:
+#
+#   <dir>/run.json                      the run the answers belong to
+#   <dir>/results/<part>.csv            partial answers, AgentAnswers.csv rows
+#   <dir>/queue/todo/<task>             unclaimed batches of [set, problem]
+#   <dir>/queue/leased/<task>.<attempt>.<worker>   claimed batches
+#   <dir>/queue/failed/<task>           batches that used up their attempts
+#
+# Partition mode needs no queue: worker i of n solves every n-th problem of
+# the corpus, starting at the i-th, into results/shard-<i>-of-<n>.csv, and a
+# rerun of a crashed shard resumes after its last written answer.
+#
+# Queue mode hands out batches. A worker claims one by renaming it into
+# leased/, which only one of several racing workers can win, and touches the
+# lease after every problem. A lease untouched for leaseSeconds belongs to a
+# crashed worker and is claimed again with the next attempt number, up to
+# maxAttempts; leaseSeconds must exceed the clock skew between nodes. The
+# answers of a batch are written as one results file before its lease is
+# removed, so a batch is either answered or still queued.
+#
+# run.json holds the Agent fingerprint, the problem selection and the split
+# (shard count or batch size). init or the first partition worker records
+# it, and workers with another Agent configuration or split refuse to add to
+# the directory, so old answers are never taken for current ones.
+#
+# merge then writes AgentAnswers.csv in corpus order for RavensGrader.grade,
+# from the results files of the recorded split only.
+
+
+def problemKeys(sets='*', problems='*', corpus=None):
+    for problemSet in iterProblemSets(sets, corpus):
+        for problemName in problemSet.problemNames():
+            if fnmatch.fnmatch(problemName, problems):
+                yield problemSet.name, problemName
+
+
+def answerLine(key, answer):
+    return '%s,%s,%d\n' % (key[0], key[1], answer)
+
+
+# Returns {(set, problem): answer} from an answers file, skipping a last line
+# cut short by a crash; a missing file has no answers.
+def readAnswers(fileName):
+    answers = {}
+    try:
+        with open(fileName, newline='') as r:
+            for row in csv.DictReader(r):
+                try:
+                    answers[row['ProblemSet'], row['RavensProblem']] = int(
+                        row[ANSWER_COLUMN])
+                except (TypeError, ValueError):
+                    pass
+    except FileNotFoundError:
+        pass
+    return answers
+
+
+def writeAnswers(fileName, answers):
+    directory = os.path.dirname(os.path.abspath(fileName))
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as w:
+        w.write("ProblemSet,RavensProblem,Agent's Answer\n")
+        for key, answer in answers.items():
+            w.write(answerLine(key, answer))
+    os.replace(tmp, fileName)
+
+
+def readRun(directory):
+    try:
+        with open(os.path.join(directory, RUN_FILE)) as r:
+            return json.load(r)
+    except FileNotFoundError:
+        return None
+
+
+# Records the run of the directory unless one is recorded already, which then
+# has to be the same run. The file is linked into place, so of two racing
+# workers exactly one records its run and the other checks against it.
+def recordRun(directory, run):
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as w:
+            json.dump(run, w, sort_keys=True)
+        try:
+            os.link(tmp, os.path.join(directory, RUN_FILE))
+        except FileExistsError:
+            checkRun(directory, readRun(directory), run)
+    finally:
+        os.remove(tmp)
+
+
+def checkRun(directory, recorded, run):
+    different = sorted(name for name in set(recorded) | set(run)
+                       if recorded.get(name) != run.get(name))
+    if different:
+        raise FileExistsError(
+            '%s holds answers of another run (different %s); use a new '
+            'directory' % (directory, ', '.join(different)))
+
+
+def workerName():
+    return '%s-%d' % (socket.gethostname(), os.getpid())
+
+
+# One Agent per worker process, parsing problems by name on demand.
+class ShardSolver:
+    def __init__(self, options, pack=None):
+        self.corpus = CorpusPack(pack) if pack else None
+        self.agent = Agent(**options)
+        self.problemSets = {}
+
+    def solve(self, setName, problemName):
+        problemSet = self.problemSets.get(setName)
+        if problemSet is None:
+            problemSet = self.problemSets[setName] = ProblemSet(
+                setName, self.corpus, lazy=True)
+        return self.agent.Solve(problemSet.parseProblem(problemName))
+
+    def close(self):
+        self.agent.close()
+
+
+def runShard(directory, shard, shards, solver, sets='*', problems='*'):
+    recordRun(directory, {'fingerprint': solver.agent.fingerprint(),
+                          'sets': sets, 'problems': problems,
+                          'shards': shards})
+    results = os.path.join(directory, 'results')
+    os.makedirs(results, exist_ok=True)
+    fileName = os.path.join(results, 'shard-%d-of-%d.csv' % (shard, shards))
+    answers = readAnswers(fileName)
+    writeAnswers(fileName, answers)
+    solved = 0
+    with open(fileName, 'a') as w:
+        for index, key in enumerate(problemKeys(sets, problems,
+                                                solver.corpus)):
+            if index % shards != shard or key in answers:
+                continue
+            w.write(answerLine(key, solver.solve(*key)))
+            w.flush()
+            solved += 1
+    return solved
+
+
+class ShardQueue:
+    def __init__(self, directory, worker=None,
+                 leaseSeconds=DEFAULT_LEASE_SECONDS,
+                 maxAttempts=DEFAULT_MAX_ATTEMPTS):
+        self.directory = directory
+        self.worker = worker or workerName()
+        self.leaseSeconds = leaseSeconds
+        self.maxAttempts = maxAttempts
+        self.queue = os.path.join(directory, 'queue')
+        self.todo = os.path.join(self.queue, 'todo')
+        self.leased = os.path.join(self.queue, 'leased')
+        self.failed = os.path.join(self.queue, 'failed')
+        self.results = os.path.join(directory, 'results')
+
+    # Writes the batches into a staging directory renamed into place at the
+    # end, so workers never see a half-written queue. run identifies the
+    # Agent and selection (see recordRun); the batch size is added to it.
+    def create(self, keys, run, batchSize=DEFAULT_BATCH_SIZE):
+        if os.path.exists(self.queue):
+            raise FileExistsError('%s already has a queue' % self.directory)
+        recordRun(self.directory, dict(run, batchSize=batchSize))
+        os.makedirs(self.results, exist_ok=True)
+        staging = tempfile.mkdtemp(dir=self.directory, prefix='queue.')
+        try:
+            for name in ('todo', 'leased', 'failed'):
+                os.mkdir(os.path.join(staging, name))
+            batches = [keys[start:start + batchSize]
+                       for start in range(0, len(keys), batchSize)]
+            for number, batch in enumerate(batches):
+                with open(os.path.join(staging, 'todo', '%06d' % number),
+                          'w') as w:
+                    json.dump(batch, w)
+            os.rename(staging, self.queue)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        return len(batches)
+
+    def leasePath(self, task, attempt):
+        return os.path.join(self.leased, '%s.%d.%s' % (task, attempt,
+                                                       self.worker))
+
+    # Moves a file to target if no other worker got there first. The file is
+    # touched before the rename, so a lease is never claimed already expired.
+    def take(self, path, target):
+        try:
+            os.utime(path)
+            os.rename(path, target)
+        except FileNotFoundError:
+            return False
+        return True
+
+    # Refuses a worker whose Agent differs from the one the queue was made
+    # for.
+    def join(self, fingerprint):
+        run = readRun(self.directory)
+        if not os.path.isdir(self.queue) or run is None:
+            raise FileNotFoundError('%s has no queue; run init first'
+                                    % self.directory)
+        checkRun(self.directory, {'fingerprint': run['fingerprint']},
+                 {'fingerprint': fingerprint})
+
+    # Returns (lease, task, keys) for a queued batch or an expired lease, or
+    # None when nothing can be claimed right now.
+    def claim(self):
+        for task in sorted(os.listdir(self.todo)):
+            lease = self.leasePath(task, 1)
+            if self.take(os.path.join(self.todo, task), lease):
+                return lease, task, self.readBatch(lease)
+
+        now = time.time()
+        for name in sorted(os.listdir(self.leased)):
+            path = os.path.join(self.leased, name)
+            try:
+                expired = now - os.stat(path).st_mtime > self.leaseSeconds
+            except FileNotFoundError:
+                continue
+            if not expired:
+                continue
+            task, attempt, _ = name.split('.', 2)
+            if os.path.exists(self.resultPath(task)):
+                self.release(path)
+            elif int(attempt) >= self.maxAttempts:
+                self.take(path, os.path.join(self.failed, task))
+            else:
+                lease = self.leasePath(task, int(attempt) + 1)
+                if self.take(path, lease):
+                    return lease, task, self.readBatch(lease)
+        return None
+
+    def readBatch(self, lease):
+        with open(lease) as r:
+            return [tuple(key) for key in json.load(r)]
+
+    # Renews the lease; False means it expired and another worker took it.
+    def heartbeat(self, lease):
+        try:
+            os.utime(lease)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def resultPath(self, task):
+        return os.path.join(self.results, 'task-%s.csv' % task)
+
+    def complete(self, lease, task, answers):
+        writeAnswers(self.resultPath(task), answers)
+        self.release(lease)
+
+    def release(self, lease):
+        try:
+            os.remove(lease)
+        except FileNotFoundError:
+            pass
+
+    # True once no batch is queued or leased, i.e. every batch is answered
+    # or failed.
+    def finished(self):
+        return not os.listdir(self.todo) and not os.listdir(self.leased)
+
+    def status(self):
+        return {'todo': len(os.listdir(self.todo)),
+                'leased': len(os.listdir(self.leased)),
+                'failed': sorted(os.listdir(self.failed)),
+                'answered': len(glob.glob(self.resultPath('*')))}
+
+
+# Claims and solves batches until the queue is finished, waiting for leases
+# held by other workers to be completed or to expire. A batch whose lease was
+# lost midway is abandoned to the worker that took it over.
+def runQueue(queue, solver, pollSeconds=DEFAULT_POLL_SECONDS):
+    queue.join(solver.agent.fingerprint())
+    solved = 0
+    while True:
+        claimed = queue.claim()
+        if claimed is None:
+            if queue.finished():
+                return solved
+            time.sleep(pollSeconds)
+            continue
+        lease, task, keys = claimed
+        answers = {}
+        for key in keys:
+            answers[key] = solver.solve(*key)
+            if not queue.heartbeat(lease):
+                break
+        else:
+            queue.complete(lease, task, answers)
+            solved += len(keys)
+
+
+# Writes the answers of the recorded run's results files to output in corpus
+# order and returns the problems without an answer. Missing problems are only
+# written, as skipped (-1), with skipMissing; otherwise output is left
+# untouched.
+def merge(directory, output='AgentAnswers.csv', sets='*', problems='*',
+          pack=None, skipMissing=False):
+    run = readRun(directory)
+    if run is None:
+        raise FileNotFoundError('%s has no run to merge' % directory)
+    if 'shards' in run:
+        pattern = 'shard-*-of-%d.csv' % run['shards']
+    else:
+        pattern = 'task-*.csv'
+    answers = {}
+    for fileName in sorted(glob.glob(os.path.join(directory, 'results',
+                                                  pattern))):
+        answers.update(readAnswers(fileName))
+    corpus = CorpusPack(pack) if pack else None
+    keys = list(problemKeys(sets, problems, corpus))
+    missing = [key for key in keys if key not in answers]
+    if not missing or skipMissing:
+        writeAnswers(output, {key: answers.get(key, -1) for key in keys})
+    return missing
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Solve the corpus across several processes or nodes '
+                    'sharing a directory, then merge their answers into '
+                    'AgentAnswers.csv.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def addSelection(command):
+        command.add_argument('directory', help='shared shard directory')
+        command.add_argument('--sets', default='*',
+                             help='glob on set names (default: all)')
+        command.add_argument('--problems', default='*',
+                             help='glob on problem names (default: all)')
+        command.add_argument('--pack',
+                             help='corpus pack (see CorpusPack.py) to load '
+                                  'the sets from')
+        return command
+
+    init = addSelection(commands.add_parser(
+        'init', help='fill the work queue with batches of problems'))
+    init.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                      help='problems per leased batch')
+    init.add_argument('--verbal', action='store_true',
+                      help='the workers will pass --verbal')
+
+    work = addSelection(commands.add_parser(
+        'work', help='solve a partition, or batches from the queue'))
+    work.add_argument('--shard', type=int,
+                      help='partition mode: index of this worker (0-based)')
+    work.add_argument('--shards', type=int,
+                      help='partition mode: total number of workers')
+    work.add_argument('--lease-seconds', type=float,
+                      default=DEFAULT_LEASE_SECONDS,
+                      help='queue mode: idle time after which a lease is '
+                           'taken over')
+    work.add_argument('--max-attempts', type=int,
+                      default=DEFAULT_MAX_ATTEMPTS,
+                      help='queue mode: claims of a batch before it is '
+                           'moved to failed/')
+    work.add_argument('--poll-seconds', type=float,
+                      default=DEFAULT_POLL_SECONDS,
+                      help='queue mode: wait between claims while other '
+                           'workers hold every lease')
+    work.add_argument('--metric-cache',
+                      help='SQLite file caching pair metrics by figure '
+                           'content across workers and runs')
+    work.add_argument('--figure-cache', nargs='?', const=DEFAULT_CACHE_DIR,
+                      help='cache binarized figures in this directory '
+                           'across runs')
+    work.add_argument('--verbal', action='store_true',
+                      help='solve from verbal descriptions where they exist')
+
+    mergeCommand = addSelection(commands.add_parser(
+        'merge', help='write AgentAnswers.csv from the partial answers'))
+    mergeCommand.add_argument('--output', default='AgentAnswers.csv')
+    mergeCommand.add_argument('--skip-missing', action='store_true',
+                              help='answer unsolved problems with -1 '
+                                   'instead of failing')
+    mergeCommand.add_argument('--grade', action='store_true',
+                              help='run RavensGrader.grade on the result')
+
+    status = commands.add_parser('status', help='print queue progress')
+    status.add_argument('directory')
+    args = parser.parse_args()
+
+    if args.command == 'init':
+        corpus = CorpusPack(args.pack) if args.pack else None
+        keys = list(problemKeys(args.sets, args.problems, corpus))
+        agent = Agent(**buildAgentOptions(verbal=args.verbal))
+        run = {'fingerprint': agent.fingerprint(), 'sets': args.sets,
+               'problems': args.problems}
+        try:
+            batches = ShardQueue(args.directory).create(keys, run,
+                                                        args.batch_size)
+        except FileExistsError as error:
+            sys.exit(str(error))
+        print('Queued %d problems in %d batches' % (len(keys), batches))
+
+    elif args.command == 'work':
+        if (args.shard is None) != (args.shards is None):
+            parser.error('--shard and --shards go together')
+        if args.shards is not None and not 0 <= args.shard < args.shards:
+            parser.error('--shard must be in [0, --shards)')
+        solver = ShardSolver(buildAgentOptions(args.metric_cache,
+                                               verbal=args.verbal,
+                                               figureCache=args.figure_cache),
+                             args.pack)
+        start = time.perf_counter()
+        try:
+            if args.shards is not None:
+                solved = runShard(args.directory, args.shard, args.shards,
+                                  solver, args.sets, args.problems)
+            else:
+                queue = ShardQueue(args.directory,
+                                   leaseSeconds=args.lease_seconds,
+                                   maxAttempts=args.max_attempts)
+                solved = runQueue(queue, solver, args.poll_seconds)
+        except (FileExistsError, FileNotFoundError) as error:
+            sys.exit(str(error))
+        finally:
+            solver.close()
+        print('%s solved %d problems in %.2fs' % (
+            workerName(), solved, time.perf_counter() - start))
+
+    elif args.command == 'merge':
+        try:
+            missing = merge(args.directory, args.output, args.sets,
+                            args.problems, args.pack, args.skip_missing)
+        except FileNotFoundError as error:
+            sys.exit(str(error))
+        for setName, problemName in missing[:10]:
+            print('No answer for %s / %s' % (setName, problemName))
+        if missing and not args.skip_missing:
+            sys.exit('%d problems have no answer; rerun their workers or '
+                     'pass --skip-missing' % len(missing))
+        print('Wrote %s' % args.output)
+        if args.grade:
+            grade()
+
+    else:
+        state = ShardQueue(args.directory).status()
+        print('%d queued, %d leased, %d answered, %d failed' % (
+            state['todo'], state['leased'], state['answered'],
+            len(state['failed'])))
+        for task in state['failed']:
+            print('Failed batch %s' % task)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import hashlib
+import json
+import os
+import tempfile
+
+DEFAULT_MANIFEST = '.solve_manifest.json'
+
+
+# Remembers the answer given to every problem together with a fingerprint of
+# its inputs, so an incremental run only re-solves problems whose figures,
+# problem data or Agent scoring configuration changed since the last run.
+class SolveManifest:
+    def __init__(self, agentFingerprint, fileName=DEFAULT_MANIFEST):
+        self.agentFingerprint = agentFingerprint
+        self.fileName = fileName
+        self.entries = {}
+        try:
+            with open(fileName) as r:
+                self.entries = json.load(r).get('problems', {})
+        except (OSError, ValueError):
+            pass
+
+    # Hashes the parsed problem (type, flags, verbal attributes), each
+    # figure's source and the Agent fingerprint. A figure's source is its
+    # PNG bytes, or its packed plane when it is only served from a
+    # CorpusPack; planes attached by a Prefetcher do not change it. The
+    # result is kept on the problem, so a Prefetcher checking the manifest
+    # and the solve loop hash each problem once.
+    def fingerprint(self, problem):
+        fingerprint = getattr(problem, 'manifestFingerprint', None)
+        if fingerprint is None:
+            fingerprint = problem.manifestFingerprint = self.hashProblem(
+                problem, self.agentFingerprint)
+        return fingerprint
+
+    # Also used on its own (see Sweep.py) to key results derived from a
+    # problem's inputs.
+    @staticmethod
+    def hashProblem(problem, agentFingerprint=''):
+        digest = hashlib.sha1(agentFingerprint.encode())
+        description = [problem.problemType, problem.hasVisual,
+                       problem.hasVerbal]
+        for name, figure in sorted(problem.figures.items()):
+            objects = sorted((objectName, sorted(obj.attributes.items()))
+                             for objectName, obj in figure.objects.items())
+            description.append([name, objects])
+        digest.update(json.dumps(description).encode())
+
+        for name, figure in sorted(problem.figures.items()):
+            digest.update(name.encode())
+            try:
+                with open(figure.visualFilename, 'rb') as r:
+                    digest.update(r.read())
+            except FileNotFoundError:
+                packed = figure.packedFigure
+                digest.update(str(packed.threshold).encode())
+                digest.update(packed.bits.tobytes())
+        return digest.hexdigest()
+
+    # Returns the recorded answer if the problem's fingerprint is unchanged,
+    # otherwise None.
+    def answer(self, setName, problemName, fingerprint):
+        entry = self.entries.get(setName + '/' + problemName)
+        if entry is None or entry['fingerprint'] != fingerprint:
+            return None
+        return entry['answer']
+
+    def record(self, setName, problemName, fingerprint, answer):
+        self.entries[setName + '/' + problemName] = {
+            'fingerprint': fingerprint, 'answer': answer}
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.fileName))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as w:
+            json.dump({'problems': self.entries}, w, indent=1, sort_keys=True)
+        os.replace(tmp, self.fileName)
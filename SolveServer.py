@@ -0,0 +1,279 @@
+import argparse
+import base64
+import io
+import json
+import os
+import signal
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+from Agent import Agent
+from MetricCache import DEFAULT_MAX_ENTRIES
+from RavensFigure import RavensFigure
+from RavensProblem import RavensProblem
+
+DEFAULT_PORT = 8637
+
+# Decoded figures each worker keeps, keyed by PNG path and modification time.
+DEFAULT_WARM_FIGURES = 4096
+
+# Figures of each problem type, testers first.
+FIGURE_NAMES = {'2x2': 'ABC123456', '3x3': 'ABCDEFGH12345678'}
+
+# The SolveWorker of a pool process, built once by initWorker.
+poolWorker = None
+
+
+def initWorker(agentOptions):
+    global poolWorker
+    # The server process handles Ctrl-C and shuts the pool down itself.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    poolWorker = SolveWorker(agentOptions)
+
+
+def solveInWorker(problems):
+    return poolWorker.solve(problems)
+
+
+# A warm Agent plus an LRU of the figures it decoded, so problems sent again
+# (or sharing PNG files) skip decoding. An edited PNG has a new modification
+# time and is decoded again.
+class SolveWorker:
+    def __init__(self, agentOptions, maxFigures=DEFAULT_WARM_FIGURES):
+        self.agent = Agent(**agentOptions)
+        self.maxFigures = maxFigures
+        self.figures = OrderedDict()
+
+    def load(self, figure):
+        data = getattr(figure, 'pngBytes', None)
+        if data is not None:
+            return self.agent.blackAndWhite(Image.open(io.BytesIO(data)))
+
+        stat = os.stat(figure.visualFilename)
+        key = (os.path.abspath(figure.visualFilename), stat.st_mtime_ns,
+               stat.st_size)
+        packed = self.figures.get(key)
+        if packed is None:
+            packed = self.figures[key] = self.agent.loadFigure(figure)
+            if len(self.figures) > self.maxFigures:
+                self.figures.popitem(last=False)
+        else:
+            self.figures.move_to_end(key)
+        return packed
+
+    # Returns a result dict per problem: its answer and every candidate's
+    # score, best first (the table Agent.Solve prints).
+    def solve(self, problems):
+        results = []
+        for problem in problems:
+            for figure in problem.figures.values():
+                figure.packedFigure = self.load(figure)
+            candidates = self.agent.rank(problem)
+            results.append({
+                'name': problem.name,
+                'answer': int(candidates[0].key),
+                'scores': [{'key': candidate.key, 'score': candidate.score,
+                            'pruned': candidate.pruned}
+                           for candidate in candidates],
+            })
+        return results
+
+    def close(self):
+        if self.agent.metricCache is not None:
+            self.agent.metricCache.close()
+
+
+# Builds a problem from a problem folder laid out like those under Problems/
+# (ProblemData.txt plus one PNG per figure).
+def problemFromPath(path):
+    path = os.path.normpath(path)
+    problemName = os.path.basename(path)
+    setName = os.path.basename(os.path.dirname(path))
+    with open(os.path.join(path, 'ProblemData.txt')) as r:
+        problemType = r.readline().rstrip()
+    if problemType not in FIGURE_NAMES:
+        raise ValueError('Unknown problem type in %s: %s' % (path, problemType))
+
+    problem = RavensProblem(problemName, problemType, setName, True, False)
+    for name in FIGURE_NAMES[problemType]:
+        figure = RavensFigure(name, problemName, setName)
+        figure.visualFilename = os.path.join(path, name + '.png')
+        problem.figures[name] = figure
+    return problem
+
+
+# Builds a problem from {"name", "figures": {figure name: base64 PNG}}; the
+# type follows from the figure names unless "problemType" is given.
+def problemFromFigures(entry):
+    figures = entry['figures']
+    problemType = entry.get('problemType') or ('3x3' if 'H' in figures
+                                               else '2x2')
+    if problemType not in FIGURE_NAMES:
+        raise ValueError('Unknown problem type: %s' % problemType)
+    missing = [name for name in FIGURE_NAMES[problemType]
+               if name not in figures]
+    if missing:
+        raise ValueError('Missing figures: %s' % ', '.join(missing))
+
+    name = entry.get('name', 'Inline Problem')
+    problem = RavensProblem(name, problemType, '', True, False)
+    for key in FIGURE_NAMES[problemType]:
+        figure = RavensFigure(key, name, '')
+        figure.pngBytes = base64.b64decode(figures[key])
+        problem.figures[key] = figure
+    return problem
+
+
+def parseProblem(entry):
+    if isinstance(entry, str):
+        return problemFromPath(entry)
+    if 'path' in entry:
+        return problemFromPath(entry['path'])
+    return problemFromFigures(entry)
+
+
+class SolveHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/health':
+            self.reply(200, self.server.status())
+        else:
+            self.reply(404, {'error': 'Unknown path: %s' % self.path})
+
+    # POST /solve {"problems": [path | {"path"} | {"name", "figures"}, ...]}
+    # answers with {"results": [...], "seconds": ...} in request order.
+    # POST /shutdown stops the server once in-flight requests are answered.
+    def do_POST(self):
+        if self.path == '/shutdown':
+            self.reply(200, {'status': 'shutting down'})
+            threading.Thread(target=self.server.shutdown).start()
+            return
+        if self.path != '/solve':
+            self.reply(404, {'error': 'Unknown path: %s' % self.path})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length))
+            problems = [parseProblem(entry) for entry in body['problems']]
+        except (ValueError, KeyError, TypeError, OSError) as error:
+            self.reply(400, {'error': '%s: %s' % (type(error).__name__, error)})
+            return
+
+        start = time.perf_counter()
+        try:
+            results = self.server.solve(problems)
+        except (ValueError, OSError) as error:
+            self.reply(400, {'error': '%s: %s' % (type(error).__name__, error)})
+            return
+        except Exception as error:
+            self.reply(500, {'error': '%s: %s' % (type(error).__name__, error)})
+            return
+        self.reply(200, {'results': results,
+                         'seconds': time.perf_counter() - start})
+
+    def reply(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+# Keeps Agents, decoded figures and metric caches warm between requests.
+# With one worker, batches are solved in the server process one request at a
+# time, on a single solver thread that builds, uses and closes the Agent
+# (an SQLite connection only works on the thread that opened it); with more,
+# each batch is split across a process pool and answered in order. Request threads are not daemonic, so server_close() waits for the
+# requests in flight before the pool is shut down.
+class SolveServer(ThreadingHTTPServer):
+    daemon_threads = False
+
+    def __init__(self, address, workers=1, agentOptions=None, verbose=False):
+        super().__init__(address, SolveHandler)
+        agentOptions = agentOptions or {}
+        self.workers = workers
+        self.verbose = verbose
+        self.solved = 0
+        self.lock = threading.Lock()
+        self.worker = None
+        self.solver = None
+        self.executor = None
+        if workers > 1:
+            self.executor = ProcessPoolExecutor(
+                max_workers=workers, initializer=initWorker,
+                initargs=(agentOptions,))
+        else:
+            self.solver = ThreadPoolExecutor(max_workers=1)
+            self.worker = self.solver.submit(SolveWorker,
+                                             agentOptions).result()
+
+    def solve(self, problems):
+        if self.executor is None:
+            results = self.solver.submit(self.worker.solve, problems).result()
+        else:
+            size = -(-len(problems) // self.workers) or 1
+            futures = [self.executor.submit(solveInWorker,
+                                            problems[start:start + size])
+                       for start in range(0, len(problems), size)]
+            results = [result for future in futures
+                       for result in future.result()]
+        with self.lock:
+            self.solved += len(results)
+        return results
+
+    def status(self):
+        return {'status': 'ok', 'workers': self.workers, 'solved': self.solved}
+
+    def server_close(self):
+        super().server_close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        if self.solver is not None:
+            self.solver.submit(self.worker.close).result()
+            self.solver.shutdown(wait=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve Agent answers over HTTP on localhost.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='solver processes (0 uses every core)')
+    parser.add_argument('--metric-cache',
+                        help='SQLite file backing the pair metric cache')
+    parser.add_argument('--verbose', action='store_true',
+                        help='log every request')
+    args = parser.parse_args()
+
+    workers = args.workers if args.workers > 0 else os.cpu_count()
+    agentOptions = dict(metricCacheSize=DEFAULT_MAX_ENTRIES,
+                        metricCacheFile=args.metric_cache)
+    server = SolveServer((args.host, args.port), workers, agentOptions,
+                         args.verbose)
+
+    # SIGTERM stops the server like Ctrl-C does; shutdown() has to be called
+    # from another thread than the one running serve_forever().
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(
+        target=server.shutdown).start())
+    print('Serving on http://%s:%d' % server.server_address[:2], flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+import time
+from contextlib import contextmanager
+
+
+# Accumulates wall time per named stage. An Agent given a StageTimer wraps
+# each step of Solve in timer.stage(name); without one the stages cost
+# nothing.
+class StageTimer:
+    def __init__(self):
+        self.totals = {}
+        self.counts = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.totals[name] = self.totals.get(name, 0.0) + elapsed
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def reset(self):
+        self.totals.clear()
+        self.counts.clear()
@@ -0,0 +1,251 @@
+import argparse
+import csv
+import hashlib
+import itertools
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from Agent import Agent
+from MetricEngine import PAIR_METRICS, MetricEngine
+from PackedFigure import PackedFigure
+from ProblemSet import iterProblems
+from Segmentation import segment
+from SolveManifest import SolveManifest
+from TransformEngine import TransformSearch
+
+DEFAULT_CACHE_DIR = '.sweep_cache'
+NORMALIZATIONS = ['shared', 'direction']
+
+
+# Raw metric arrays of one problem at one threshold, plus what scoring them
+# needs: the relation diffs of every metric and their normalization totals.
+# The truth is read from ProblemAnswer.txt by the caller on every run.
+class SweepProblem:
+    def __init__(self, meta, truth, testerValues, candidateValues, template):
+        self.meta = meta
+        self.truth = truth
+        self.template = template
+        self.diffs = np.abs(testerValues[template.relationTester]
+                            - candidateValues[:, template.relationLonely])
+        # 'shared' divides by each metric's total over all candidates and
+        # relations, as ScoreTable.normalize does; 'direction' by its total
+        # over the relations of the same direction, whatever their pair type.
+        # That is the keying of the original per-direction totalsForNorm,
+        # whose directions all aliased one dict (dict.fromkeys(keys, {})),
+        # so the original scorer actually normalized as 'shared'.
+        directions = sorted({direction for _, direction in template.groups})
+        groupDirection = np.array([directions.index(direction)
+                                   for _, direction in template.groups],
+                                  dtype=np.intp)
+        groups = groupDirection[template.lonelyGroup[template.relationLonely]]
+        directionTotals = np.zeros((len(directions), self.diffs.shape[2]))
+        np.add.at(directionTotals, groups, self.diffs.sum(axis=0))
+        self.totals = {'shared': self.diffs.sum(axis=(0, 1)),
+                       'direction': directionTotals[groups]}
+
+    def answer(self, columns, weights, normalization):
+        diffs = self.diffs[:, :, columns]
+        totals = self.totals[normalization][..., columns]
+        normalized = np.divide(diffs, totals, out=np.zeros_like(diffs),
+                               where=totals != 0)
+        scores = (normalized * weights).sum(axis=(1, 2))
+        return int(self.meta['candidates'][int(np.argmin(scores))])
+
+
+def readTruth(setName, problemName):
+    fileName = os.path.join('Problems', setName, problemName,
+                            'ProblemAnswer.txt')
+    try:
+        with open(fileName) as r:
+            return int(r.read())
+    except (OSError, ValueError):
+        return None
+
+
+# Keys the arrays by the threshold, the metrics, the scoring sources and the
+# inputs of every matched problem (its SolveManifest hash of problem data
+# and PNG bytes), so editing or adding a problem recomputes them.
+def cachePath(cacheDir, threshold, metrics, found):
+    digest = hashlib.sha1(json.dumps([threshold, metrics]).encode())
+    for setName, problem in found:
+        digest.update(('%s/%s %s\n' % (setName, problem.name,
+                                       SolveManifest.hashProblem(problem)))
+                      .encode())
+    digest = Agent.sourceDigest(digest, (Agent, MetricEngine, PackedFigure,
+                                         TransformSearch, segment))
+    return os.path.join(cacheDir, 'threshold_%d_%s.npz' % (threshold,
+                                                          digest[:16]))
+
+
+# Loads the problems at the threshold and computes the raw values of every
+# metric, timing the load and each metric separately.
+def computeArrays(threshold, metrics, found):
+    agent = Agent(threshold=threshold)
+    arrays = {}
+    metas = []
+    for setName, problem in found:
+        start = time.perf_counter()
+        testers, candidates = agent.initElements(problem)
+        template = agent.getPairTemplate(testers.size)
+        engine = MetricEngine([element.img for element in
+                               list(testers) + candidates])
+        loadSeconds = time.perf_counter() - start
+
+        testerColumns, candidateColumns, metricSeconds = [], [], {}
+        for name in metrics:
+            start = time.perf_counter()
+            testerValues, candidateValues = agent.metricValues(
+                engine, template, [name], len(candidates))
+            metricSeconds[name] = time.perf_counter() - start
+            testerColumns.append(testerValues)
+            candidateColumns.append(candidateValues)
+
+        index = len(metas)
+        arrays['tester_%d' % index] = np.concatenate(testerColumns, axis=-1)
+        arrays['candidate_%d' % index] = np.concatenate(candidateColumns,
+                                                        axis=-1)
+        metas.append({'set': setName, 'problem': problem.name,
+                      'testers': int(testers.size),
+                      'candidates': [candidate.key for candidate in candidates],
+                      'loadSeconds': loadSeconds,
+                      'metricSeconds': metricSeconds})
+    return metas, arrays
+
+
+# Returns the SweepProblems of a threshold that have a ProblemAnswer.txt,
+# computing and storing the raw arrays of every matching problem only when no
+# stored copy for these metrics, sources and inputs exists.
+def loadArrays(cacheDir, threshold, metrics, sets, problems):
+    found = list(iterProblems(sets, problems))
+    fileName = cachePath(cacheDir, threshold, metrics, found)
+    try:
+        with np.load(fileName) as stored:
+            metas = json.loads(str(stored['meta']))
+            arrays = {name: stored[name] for name in stored.files
+                      if name != 'meta'}
+    except OSError:
+        metas, arrays = computeArrays(threshold, metrics, found)
+        os.makedirs(cacheDir, exist_ok=True)
+        np.savez(fileName, meta=np.array(json.dumps(metas)), **arrays)
+
+    agent = Agent(cacheDir=None)
+    stored = []
+    for index, meta in enumerate(metas):
+        truth = readTruth(meta['set'], meta['problem'])
+        if truth is not None:
+            stored.append(SweepProblem(
+                meta, truth, arrays['tester_%d' % index],
+                arrays['candidate_%d' % index],
+                agent.getPairTemplate(meta['testers'])))
+    return stored
+
+
+def defaultGrid():
+    subsets = [list(names) for size in range(1, len(Agent.defaultMetrics) + 1)
+               for names in itertools.combinations(Agent.defaultMetrics, size)]
+    return {'thresholds': [100], 'metrics': subsets, 'weights': [{}],
+            'normalization': NORMALIZATIONS}
+
+
+# Scores every configuration of the grid from the stored arrays and returns
+# one row per configuration. Latency is the measured load and metric time
+# of the configuration's metrics plus its scoring time, per problem.
+def sweep(grid, cacheDir, sets, problems):
+    metrics = sorted({name for names in grid['metrics'] for name in names})
+    unknown = [name for name in metrics if name not in PAIR_METRICS]
+    if unknown:
+        raise ValueError('Unknown metrics: %s' % ', '.join(unknown))
+    for normalization in grid['normalization']:
+        if normalization not in NORMALIZATIONS:
+            raise ValueError('Unknown normalization: %s' % normalization)
+
+    rows = []
+    for threshold in grid['thresholds']:
+        stored = loadArrays(cacheDir, threshold, metrics, sets, problems)
+        if not stored:
+            continue
+        for names, weights, normalization in itertools.product(
+                grid['metrics'], grid['weights'], grid['normalization']):
+            columns = [metrics.index(name) for name in names]
+            weightArray = np.array([weights.get(name, 1.0)
+                                    for name in names])
+            start = time.perf_counter()
+            correct = sum(problem.answer(columns, weightArray, normalization)
+                          == problem.truth for problem in stored)
+            scoring = time.perf_counter() - start
+            solving = sum(problem.meta['loadSeconds']
+                          + sum(problem.meta['metricSeconds'][name]
+                                for name in names)
+                          for problem in stored)
+            rows.append({
+                'threshold': threshold,
+                'metrics': ','.join(names),
+                'weights': ','.join('%g' % weight for weight in weightArray),
+                'normalization': normalization,
+                'correct': correct,
+                'problems': len(stored),
+                'accuracy': correct / len(stored),
+                'msPerProblem': 1000 * (solving + scoring) / len(stored),
+            })
+    rows.sort(key=lambda row: (-row['accuracy'], row['msPerProblem']))
+    return rows
+
+
+def report(rows):
+    print('%-9s %-48s %-12s %-10s %-9s %s' % (
+        'threshold', 'metrics', 'weights', 'norm', 'accuracy', 'ms/problem'))
+    for row in rows:
+        print('%-9d %-48s %-12s %-10s %3d/%-5d %.2f' % (
+            row['threshold'], row['metrics'], row['weights'],
+            row['normalization'], row['correct'], row['problems'],
+            row['msPerProblem']))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Evaluate a grid of scoring configurations against '
+                    'ProblemAnswer.txt from cached raw metric arrays.')
+    parser.add_argument('--sets', default='*', help='glob on set names')
+    parser.add_argument('--problems', default='*',
+                        help='glob on problem names')
+    parser.add_argument('--grid',
+                        help='JSON file with "thresholds", "metrics" (lists '
+                             'of names), "weights" (dicts of name to weight) '
+                             'and "normalization" ("shared"/"direction") '
+                             'lists; missing keys use the defaults')
+    parser.add_argument('--thresholds',
+                        help='comma-separated thresholds, overriding the grid')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR)
+    parser.add_argument('--top', type=int, help='only print the best N rows')
+    parser.add_argument('--output', help='write every row to this CSV file')
+    args = parser.parse_args()
+
+    grid = defaultGrid()
+    if args.grid:
+        with open(args.grid) as r:
+            grid.update(json.load(r))
+    if args.thresholds:
+        grid['thresholds'] = [int(value)
+                              for value in args.thresholds.split(',')]
+
+    start = time.perf_counter()
+    rows = sweep(grid, args.cache_dir, args.sets, args.problems)
+    if not rows:
+        sys.exit('No problems with a ProblemAnswer.txt matched.')
+    report(rows[:args.top] if args.top else rows)
+    print('%d configurations in %.2fs' % (len(rows),
+                                          time.perf_counter() - start))
+
+    if args.output:
+        with open(args.output, 'w', newline='') as w:
+            writer = csv.DictWriter(w, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import argparse
+import fnmatch
+import json
+import os
+
+# Records kept in memory before they are appended to the trace file.
+DEFAULT_BUFFER_SIZE = 256
+
+
+# Buffered JSONL sink for per-problem solve records (see Agent.traceRecord).
+# Each flush appends the buffered lines with a single O_APPEND write, so
+# worker processes can share one trace file without interleaving lines.
+class TraceWriter:
+    def __init__(self, fileName, bufferSize=DEFAULT_BUFFER_SIZE):
+        self.fileName = fileName
+        self.bufferSize = bufferSize
+        self.records = []
+
+    def record(self, entry):
+        self.records.append(json.dumps(entry))
+        if len(self.records) >= self.bufferSize:
+            self.flush()
+
+    def flush(self):
+        if not self.records:
+            return
+        data = ('\n'.join(self.records) + '\n').encode('utf-8')
+        self.records.clear()
+        fd = os.open(self.fileName, os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                     0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def readTrace(fileName):
+    with open(fileName) as r:
+        for line in r:
+            if line.strip():
+                yield json.loads(line)
+
+
+# Prints one line per traced problem (answer, margin, time) followed by the
+# totals; --margin-below lists only the problems decided by a thin margin.
+def main():
+    parser = argparse.ArgumentParser(
+        description='Summarize a JSONL trace written by Agent(traceFile=...).')
+    parser.add_argument('trace')
+    parser.add_argument('--problems', default='*',
+                        help='glob on problem names to show')
+    parser.add_argument('--margin-below', type=float,
+                        help='only show problems with a smaller margin')
+    parser.add_argument('--relations', action='store_true',
+                        help="also print the answer's normalized diffs")
+    args = parser.parse_args()
+
+    count = 0
+    seconds = 0.0
+    for record in readTrace(args.trace):
+        if not fnmatch.fnmatch(record['problem'], args.problems):
+            continue
+        if args.margin_below is not None and record['margin'] >= args.margin_below:
+            continue
+        count += 1
+        seconds += record['seconds']
+        print('%-40s answer %-2s margin %.3f  %.2f ms' % (
+            record['problem'], record['answer'], record['margin'],
+            1000 * record['seconds']))
+        if args.relations and 'normalized' in record:
+            diffs = record['normalized'].get(str(record['answer']), [])
+            for relation, values in zip(record['relations'], diffs):
+                print('    %-13s %-10s %s-%s / %s  %s' % (
+                    relation['type'], relation['direction'],
+                    relation['testers'][0], relation['testers'][1],
+                    relation['lonely'],
+                    ' '.join('%s=%.4f' % item
+                             for item in zip(record['metrics'], values))))
+
+    if count:
+        print('%d problems, %.2f ms mean' % (count, 1000 * seconds / count))
+
+
+if __name__ == '__main__':
+    main()
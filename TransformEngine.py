@@ -0,0 +1,131 @@
+import numpy as np
+
+# Pyramid level the search runs at (see PackedFigure.level); every FFT is
+# 1/factor^2 the size of a full-resolution one.
+SEARCH_FACTOR = 2
+
+# Pairs whose correlations are computed in one batched inverse FFT.
+CHUNK_SIZE = 32
+
+# The 8 symmetries of the square, in the order of the transform indices
+# TransformSearch.search returns.
+TRANSFORMS = ['identity', 'rot90', 'rot180', 'rot270', 'flip_lr', 'flip_ud',
+              'transpose', 'antitranspose']
+
+
+# Smallest 2^a 3^b 5^c >= n, a size the FFT handles efficiently.
+def fftSize(n):
+    size = max(n, 2)
+    while True:
+        rest = size
+        for factor in (2, 3, 5):
+            while rest % factor == 0:
+                rest //= factor
+        if rest == 1:
+            return size
+        size += 1
+
+
+# X[-k] along one axis: the spectrum of the figure mirrored along that axis
+# (cyclically, which only moves where the correlation peaks).
+def negate(spectrum, axis):
+    return np.roll(np.flip(spectrum, axis), 1, axis)
+
+
+# Spectra of the 8 dihedral transforms of a real figure, derived from its
+# spectrum by index permutations and conjugation instead of 8 more FFTs.
+def dihedralSpectra(spectrum):
+    transposed = spectrum.T
+    return np.stack([
+        spectrum,
+        negate(transposed, 0),
+        np.conj(spectrum),
+        negate(transposed, 1),
+        negate(spectrum, 1),
+        negate(spectrum, 0),
+        transposed,
+        np.conj(transposed),
+    ])
+
+
+# Finds, for figure pairs (a, b), the dihedral transform T and translation
+# that make T(b) overlap a the most. The overlap for every translation at
+# once is the cross-correlation of a and T(b), i.e. the inverse FFT of
+# A * conj(T(B)).
+#
+# The overlap does not depend on where each figure sits, so every figure is
+# cropped to its dark bounding box and placed at the origin. A pair is then
+# zero-padded to a square of the sum of the two crops' extents (rounded up
+# by fftSize), enough for the circular correlation to cover every linear
+# shift without wrap-around; the FFT size follows the ink, not the canvas.
+#
+# The residual is the number of pixels that still differ after the best
+# alignment: |a| + |b| - 2 * overlap.
+class TransformSearch:
+    def __init__(self, figures, factor=SEARCH_FACTOR):
+        self.figures = [figure.level(factor) for figure in figures]
+        self.dihedral = {}
+
+    # Returns the figure's dark pixels within its bounding box.
+    def crop(self, index):
+        def compute(figure):
+            top, bottom, left, right = figure.bbox
+            return np.unpackbits(figure.bits[top:bottom, left:right], axis=1)
+        return self.figures[index].feature('dark_crop', compute)
+
+    def extent(self, index):
+        return max(self.crop(index).shape)
+
+    # Returns the figure's spectrum, computed once per figure and size.
+    def spectrum(self, index, size):
+        def compute(figure):
+            crop = self.crop(index)
+            dark = np.zeros((size, size), dtype=np.float32)
+            dark[:crop.shape[0], :crop.shape[1]] = crop
+            return np.fft.fft2(dark).astype(np.complex64)
+        return self.figures[index].feature('spectrum_%d' % size, compute)
+
+    # Returns the conjugated half spectra of the figure's 8 transforms; the
+    # correlation is real, so half of its spectrum is enough for irfft2.
+    def transformed(self, index, size):
+        spectra = self.dihedral.get((index, size))
+        if spectra is None:
+            spectra = np.conj(dihedralSpectra(self.spectrum(index, size)))
+            spectra = self.dihedral[index, size] = spectra[..., :size // 2 + 1]
+        return spectra
+
+    # Returns the (pairs, 8) maximum overlap of first[i] with every transform
+    # of second[i], over all translations. Pairs are grouped by padded size,
+    # and each group is correlated in chunks of batched inverse FFTs.
+    def overlaps(self, first, second):
+        extents = [self.extent(index) for index in range(len(self.figures))]
+        groups = {}
+        for pair, (a, b) in enumerate(zip(first, second)):
+            size = fftSize(extents[a] + extents[b])
+            groups.setdefault(size, []).append(pair)
+
+        result = np.empty((len(first), len(TRANSFORMS)))
+        for size, pairs in groups.items():
+            half = size // 2 + 1
+            for start in range(0, len(pairs), CHUNK_SIZE):
+                chunk = pairs[start:start + CHUNK_SIZE]
+                product = np.stack([
+                    self.spectrum(first[pair], size)[:, :half]
+                    * self.transformed(second[pair], size)
+                    for pair in chunk])
+                correlation = np.fft.irfft2(product, s=(size, size))
+                result[chunk] = correlation.max(axis=(2, 3))
+        return np.rint(result)
+
+    # Returns (transform, residual, shiftResidual) arrays: the index into
+    # TRANSFORMS of the best alignment, its residual as a fraction of the
+    # pixels, and the same for the best translation alone.
+    def search(self, first, second):
+        overlaps = self.overlaps(first, second)
+        darkCounts = np.array([figure.darkCount for figure in self.figures])
+        total = darkCounts[first] + darkCounts[second]
+        transform = overlaps.argmax(axis=1)
+        size = self.figures[0].size
+        residual = (total - 2 * overlaps.max(axis=1)) / size
+        shiftResidual = (total - 2 * overlaps[:, 0]) / size
+        return transform, residual, shiftResidual
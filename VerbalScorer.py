@@ -0,0 +1,102 @@
+# Attributes whose values name other objects of the figure (e.g. inside:a,b).
+# Object names differ between figures, so only how many objects are named is
+# compared.
+RELATIONAL_ATTRIBUTES = {'inside', 'above', 'left-of', 'overlaps'}
+
+
+# Interns attribute names and values into small integers, shared by every
+# problem an Agent solves, so figures compare as sets of int pairs.
+class AttributeCodes:
+    def __init__(self):
+        self.codes = {}
+
+    def code(self, text):
+        code = self.codes.get(text)
+        if code is None:
+            code = self.codes[text] = len(self.codes)
+        return code
+
+    # A figure as a list of objects, each a frozenset of (name, value) codes.
+    def encodeFigure(self, figure):
+        objects = []
+        for obj in figure.objects.values():
+            pairs = []
+            for name, value in obj.attributes.items():
+                if name in RELATIONAL_ATTRIBUTES:
+                    value = str(len(value.split(',')))
+                pairs.append((self.code(name), self.code(value)))
+            objects.append(frozenset(pairs))
+        return objects
+
+
+# Pairs every object of x with the unmatched object of y sharing the most
+# attributes; returns the matched pairs and the unmatched objects of each.
+def matchObjects(x, y):
+    unmatched = list(y)
+    pairs = []
+    removed = []
+    for obj in x:
+        if not unmatched:
+            removed.append(obj)
+            continue
+        best = max(range(len(unmatched)),
+                   key=lambda index: (len(obj & unmatched[index]), -index))
+        pairs.append((obj, unmatched.pop(best)))
+    return pairs, removed, unmatched
+
+
+# The change from figure x to figure y: the number of objects added and
+# removed, and how many matched objects changed each attribute. Which values
+# changed is left out on purpose: rows of a matrix usually start from
+# different objects, so "fill changed" carries over from row to row while
+# "fill went from yes to no" often does not.
+def transformation(x, y):
+    pairs, removed, added = matchObjects(x, y)
+    changes = {}
+    for before, after in pairs:
+        for name in {name for name, value in before ^ after}:
+            changes[name] = changes.get(name, 0) + 1
+    return len(added), len(removed), changes
+
+
+def distance(s, t):
+    changes, other = s[2], t[2]
+    return (abs(s[0] - t[0]) + abs(s[1] - t[1])
+            + sum(abs(count - other.get(name, 0))
+                  for name, count in changes.items())
+            + sum(count for name, count in other.items()
+                  if name not in changes))
+
+
+# Scores candidates symbolically over the same relations as the image
+# pipeline: a relation costs the distance between the tester pair's
+# transformation and the lonely tester -> candidate one.
+class VerbalScorer:
+    def __init__(self):
+        self.attributeCodes = AttributeCodes()
+
+    # figures are the problem's RavensFigures in element order (testers,
+    # then candidates); returns one score per candidate, lower is better.
+    def scores(self, figures, template, testerCount):
+        encoded = [self.attributeCodes.encodeFigure(figure)
+                   for figure in figures]
+        signatures = {}
+
+        def signature(first, second):
+            key = (first, second)
+            value = signatures.get(key)
+            if value is None:
+                value = signatures[key] = transformation(encoded[first],
+                                                         encoded[second])
+            return value
+
+        testerSignatures = [signature(first, second) for first, second in
+                            zip(template.first.tolist(),
+                                template.second.tolist())]
+        relations = list(zip(template.relationTester.tolist(),
+                             template.relationLonely.tolist()))
+        lonely = template.lonely.tolist()
+        return [sum(distance(testerSignatures[tester],
+                             signature(lonely[position], candidate))
+                    for tester, position in relations)
+                for candidate in range(testerCount, len(figures))]
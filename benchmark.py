@@ -0,0 +1,176 @@
+import argparse
+import contextlib
+import fnmatch
+import json
+import os
+import resource
+import sys
+import time
+
+from Agent import Agent
+from CorpusPack import CorpusPack
+from FigureCache import DEFAULT_CACHE_DIR
+from ProblemSet import ProblemSet
+from StageTimer import StageTimer
+
+# 'coarse' is the coarse ranking of coarse-to-fine scoring; its metrics,
+# relations and normalization time is also counted in those stages.
+# 'pruning' is answer-only pruned scoring (--pruning), metrics included.
+# 'verbal' is verbal scoring (--verbal); problems it leaves undecided are
+# then timed in the visual stages.
+STAGES = ['load', 'pairs', 'metrics', 'relations', 'normalization',
+          'coarse', 'pruning', 'verbal']
+
+
+def loadProblems(setNames, pattern, pack):
+    corpus = CorpusPack(pack) if pack else None
+    problems = []
+    for setName in setNames:
+        for problem in ProblemSet(setName, corpus).problems:
+            if fnmatch.fnmatch(problem.name, pattern):
+                problems.append(problem)
+    return problems
+
+
+# Solves every problem once per repeat and keeps the fastest repeat of each
+# stage, which is far less noisy than the mean on a shared machine.
+def run(problems, repeat, useCache, **agentOptions):
+    agent = Agent(cacheDir=DEFAULT_CACHE_DIR if useCache else None,
+                  **agentOptions)
+    agent.timer = StageTimer()
+    best = None
+
+    for _ in range(repeat):
+        agent.timer.reset()
+        start = time.perf_counter()
+        with open(os.devnull, 'w') as sink, contextlib.redirect_stdout(sink):
+            for problem in problems:
+                agent.Solve(problem)
+        timings = dict(agent.timer.totals)
+        timings['wall'] = time.perf_counter() - start
+        if best is None:
+            best = timings
+        else:
+            best = {name: min(best.get(name, value), value)
+                    for name, value in timings.items()}
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    result = {
+        'problems': len(problems),
+        'repeat': repeat,
+        'wall': best['wall'],
+        'problemsPerSecond': len(problems) / best['wall'] if best['wall'] else None,
+        'peakRssKb': usage.ru_maxrss,
+        'stages': {name: best.get(name, 0.0) for name in STAGES},
+    }
+    if agent.pruning:
+        result['pruning'] = {name: count // repeat for name, count
+                             in agent.pruningStats.items()}
+    if agent.cascade:
+        result['cascadeExits'] = [count // repeat
+                                  for count in agent.cascadeStats]
+    return result
+
+
+# Returns a message per stage (and the overall wall time) that got slower
+# than the baseline by more than the allowed fraction. Differences below
+# minDelta seconds are treated as noise.
+def regressions(result, baseline, threshold, minDelta):
+    current = dict(result['stages'], wall=result['wall'])
+    previous = dict(baseline['stages'], wall=baseline['wall'])
+    messages = []
+    for name, value in current.items():
+        before = previous.get(name)
+        if before is None:
+            continue
+        if value > before * (1 + threshold) and value - before > minDelta:
+            messages.append('%s: %.4fs -> %.4fs (+%.0f%%)' % (
+                name, before, value, 100 * (value / before - 1)))
+    return messages
+
+
+def report(result):
+    print('%d problems, best of %d: %.3fs wall (%.1f problems/s), peak RSS %d KB'
+          % (result['problems'], result['repeat'], result['wall'],
+             result['problemsPerSecond'] or 0, result['peakRssKb']))
+    for name in STAGES:
+        print('  %-14s %.4fs' % (name, result['stages'][name]))
+    if 'pruning' in result:
+        print('  blocks evaluated: %(evaluated)d of %(possible)d'
+              % result['pruning'])
+    for stage, count in enumerate(result.get('cascadeExits', [])):
+        print('  decided at cascade stage %d: %d' % (stage + 1, count))
+
+
+# "a,b;c" -> [['a', 'b'], ['c']]
+def parseCascade(spec):
+    return [names.split(',') for names in spec.split(';')]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark Agent.Solve with a per-stage time breakdown.')
+    parser.add_argument('sets', nargs='*',
+                        help='sets to run (default: ProblemSetList.txt)')
+    parser.add_argument('--problems', default='*',
+                        help='glob on problem names, e.g. "*C-0*"')
+    parser.add_argument('--pack', help='corpus pack to load the sets from')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--cache', action='store_true',
+                        help='load figures through the on-disk figure cache')
+    parser.add_argument('--coarse', type=int, choices=[2, 4, 8],
+                        help='rank candidates at this downsampling factor first')
+    parser.add_argument('--coarse-margin', type=float, default=0.3,
+                        help='coarse margin above which the coarse answer is kept')
+    parser.add_argument('--coarse-top-k', type=int,
+                        help='approximate: re-score only the k best coarse candidates')
+    parser.add_argument('--cascade', type=parseCascade, nargs='?', const=True,
+                        help='metric stages, e.g. "darkness_ratio;'
+                             'non_matching_pixel,pixel_intersect" '
+                             '(default: Agent.defaultCascade)')
+    parser.add_argument('--cascade-margin', type=float, default=0.5,
+                        help='margin that ends the cascade early')
+    parser.add_argument('--pruning', action='store_true',
+                        help='approximate, answer-only candidate pruning')
+    parser.add_argument('--verbal', action='store_true',
+                        help='score problems with verbal descriptions from '
+                             'their attributes')
+    parser.add_argument('--output', help='write the result as JSON here')
+    parser.add_argument('--baseline',
+                        help='JSON result to compare against; exits 1 on regression')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed slowdown per stage as a fraction (default 0.2)')
+    parser.add_argument('--min-delta', type=float, default=0.005,
+                        help='ignore slowdowns smaller than this many seconds')
+    args = parser.parse_args()
+
+    setNames = args.sets
+    if not setNames:
+        with open(os.path.join('Problems', 'ProblemSetList.txt')) as r:
+            setNames = [line.rstrip() for line in r if line.rstrip()]
+
+    problems = loadProblems(setNames, args.problems, args.pack)
+    result = run(problems, args.repeat, args.cache,
+                 coarseFactor=args.coarse, coarseTopK=args.coarse_top_k,
+                 coarseMargin=args.coarse_margin, cascade=args.cascade,
+                 cascadeMargin=args.cascade_margin, verbal=args.verbal,
+                 pruning=args.pruning)
+    report(result)
+
+    if args.output:
+        with open(args.output, 'w') as w:
+            json.dump(result, w, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as r:
+            baseline = json.load(r)
+        messages = regressions(result, baseline, args.threshold,
+                               args.min_delta)
+        for message in messages:
+            print('REGRESSION ' + message)
+        if messages:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()